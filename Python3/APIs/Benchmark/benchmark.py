@@ -0,0 +1,248 @@
+import os, sys
+# remember the directory the benchmark was started from. importing checklist_answers changes the directory.
+START_DIRECTORY = os.getcwd()
+# add the parent directory and the ChecklistAnswers directory to the system path to use the l2l_api and checklist_answers modules.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'ChecklistAnswers'))
+import l2l_api, checklist_answers, mock_server, argparse, contextlib, datetime, io, json, random, shutil, tempfile, time, tracemalloc
+
+
+class Benchmark:
+    '''Measures the speed and memory use of L2LApi and ChecklistAnswers against a local MockServer, so changes to concurrency, caching or output
+    formats can be checked for regressions without a customer server.
+
+    Sample script usage:
+    $ python3 benchmark.py --checklists 20000 --latency 0.05 --rate429 0.01 --workers 1,4,8 --formats csv,parquet --json results.json
+    $ python3 benchmark.py --compare results.json
+
+    Runs three benchmarks, and prints one line per run:
+    getall : L2LApi.doGetAll of every checklist, once per number of --workers
+    lookups : L2LApi.doGetWithCache of random areas, lines, machines and products, with a MemoryCache, a new SQLiteCache and the same SQLiteCache again
+    export : ChecklistAnswers.exportAnswersToCSV of every checklist, once per output format in --formats'''
+
+    # the columns of the report: the name of each value in a result, its header, and its format
+    COLUMNS = (
+        ('name', 'benchmark', '{:<28}'), ('items', 'items', '{:>8}'), ('seconds', 'seconds', '{:>8.2f}'), ('itemspersecond', 'items/s', '{:>9.0f}'),
+        ('requests', 'requests', '{:>8}'), ('p50', 'p50 ms', '{:>7.1f}'), ('p95', 'p95 ms', '{:>7.1f}'), ('p99', 'p99 ms', '{:>7.1f}'),
+        ('megabytes', 'MB recv', '{:>8.1f}'), ('peakmemory', 'peak MB', '{:>8.1f}'), ('retries', 'retries', '{:>7}'),
+    )
+
+    def __init__(self, options):
+        '''Sets up the Benchmark class.
+        Variables:
+            options : The parsed command line options. See parseOptions'''
+
+        self.OPTIONS = options
+        self.RESULTS = []
+        self.URL = None
+        self.DIRECTORY = None  # a temporary directory for the cache files and exported files
+
+    def main(self):
+        '''Starts the mock server, runs the selected benchmarks, and prints the report.'''
+
+        server_options = {'checklists': self.OPTIONS.checklists, 'days': self.OPTIONS.days, 'answers': self.OPTIONS.answers, 'text_size': self.OPTIONS.text_size,
+                          'lookups': self.OPTIONS.lookups, 'latency': self.OPTIONS.latency, 'max_limit': self.OPTIONS.max_limit, 'rate429': self.OPTIONS.rate429,
+                          'retry_after': self.OPTIONS.retry_after}
+        print('Mock server: {}'.format(', '.join('{}={}'.format(key, value) for key, value in server_options.items())))
+
+        self.DIRECTORY = tempfile.mkdtemp(prefix='l2l-benchmark-')
+        try:
+            with mock_server.MockServer(**server_options) as server:
+                self.URL = server.URL
+                benchmarks = self.OPTIONS.benchmarks.split(',')
+                if 'getall' in benchmarks:
+                    for workers in self.splitNumbers(self.OPTIONS.workers):
+                        self.measure('getall workers={}'.format(workers), lambda hook: self.runGetAll(hook, workers))
+                if 'lookups' in benchmarks:
+                    cache_filename = os.path.join(self.DIRECTORY, 'cache.sqlite')
+                    self.measure('lookups memory', lambda hook: self.runLookups(hook, l2l_api.MemoryCache()))
+                    self.measure('lookups sqlite', lambda hook: self.runLookups(hook, l2l_api.SQLiteCache(cache_filename, self.URL)))
+                    self.measure('lookups sqlite again', lambda hook: self.runLookups(hook, l2l_api.SQLiteCache(cache_filename, self.URL)))
+                if 'export' in benchmarks:
+                    for output_format in self.OPTIONS.formats.split(','):
+                        self.measure('export ' + output_format, lambda hook: self.runExport(hook, output_format))
+                stats = server.stats()
+        finally:
+            shutil.rmtree(self.DIRECTORY, ignore_errors=True)
+
+        self.report()
+        print('Mock server answered {requests} requests, {throttled} with a 429, and sent {0:.1f} MB'.format(stats['bytes'] / 1000000, **stats))
+        if self.OPTIONS.json:
+            with open(os.path.join(START_DIRECTORY, self.OPTIONS.json), 'w') as file:
+                json.dump({'options': vars(self.OPTIONS), 'results': self.RESULTS}, file, indent=4)
+            print('Results saved to {}'.format(self.OPTIONS.json))
+        if self.OPTIONS.compare:
+            self.compare(os.path.join(START_DIRECTORY, self.OPTIONS.compare))
+
+        return None
+
+    def measure(self, name, run):
+        '''Runs one benchmark and stores its result. run is called with a hook to add to the Metrics of the API class being measured, so the latency
+        of each request is recorded. It returns the number of items processed and the Metrics. Memory is measured with tracemalloc unless --no-memory
+        is set. tracemalloc slows Python down, and does not see the memory of other processes, e.g. with --processes.'''
+
+        latencies = []
+        def hook(event):
+            if event['type'] == 'request':
+                latencies.append(event['seconds'] * 1000)
+
+        print('Running {}...'.format(name))
+        if self.OPTIONS.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            items, metrics = run(hook)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if self.OPTIONS.memory else None
+        finally:
+            if self.OPTIONS.memory:
+                tracemalloc.stop()
+
+        endpoints = metrics.stats()['endpoints'].values()
+        latencies.sort()
+        result = {
+            'name': name,
+            'items': items,
+            'seconds': seconds,
+            'itemspersecond': items / seconds if seconds else 0.0,
+            'requests': len(latencies),
+            'p50': self.percentile(latencies, 0.5),
+            'p95': self.percentile(latencies, 0.95),
+            'p99': self.percentile(latencies, 0.99),
+            'megabytes': sum(endpoint['bytes'] for endpoint in endpoints) / 1000000,
+            'peakmemory': peak / 1000000 if peak is not None else None,
+            'retries': sum(endpoint['retries'] for endpoint in endpoints),
+        }
+        self.RESULTS.append(result)
+        return result
+
+    def runGetAll(self, hook, workers):
+        '''Downloads every checklist with L2LApi.doGetAll. Returns the number of checklists.'''
+
+        metrics = l2l_api.Metrics()
+        metrics.addHook(hook)
+        with l2l_api.L2LApi(self.URL, 'benchmark', pool_maxsize=max(10, workers), rate_limiter=l2l_api.RateLimiter(self.OPTIONS.ratelimit), metrics=metrics) as l2l:
+            checklists = l2l.doGetAll('checklists', {'site': 1}, self.OPTIONS.limit, workers)
+        return len(checklists), metrics
+
+    def runLookups(self, hook, cache):
+        '''Looks up random areas, lines, machines and products with L2LApi.doGetWithCache, the way ChecklistAnswers.documentRow does. The same ids are
+        looked up on each run. Returns the number of lookups.'''
+
+        metrics = l2l_api.Metrics()
+        metrics.addHook(hook)
+        ids = random.Random(1).choices(range(1, self.OPTIONS.lookups + 1), k=self.OPTIONS.lookup_calls)
+        with l2l_api.L2LApi(self.URL, 'benchmark', rate_limiter=l2l_api.RateLimiter(self.OPTIONS.ratelimit), cache=cache, metrics=metrics) as l2l:
+            try:
+                for number, id in enumerate(ids):
+                    l2l.doGetWithCache(mock_server.MockData.LOOKUPS[number % len(mock_server.MockData.LOOKUPS)], {'site': 1, 'id': id})
+            finally:
+                cache.close()
+        return len(ids), metrics
+
+    def runExport(self, hook, output_format):
+        '''Exports every checklist with ChecklistAnswers.exportAnswersToCSV, using the --pageworkers, --shardworkers, --sharddays and --processes
+        settings. Returns the number of checklists.'''
+
+        directory = tempfile.mkdtemp(dir=self.DIRECTORY)
+        config = {
+            'apiurl': self.URL, 'apikey': 'benchmark', 'verbose': False, 'logdirectory': directory, 'csvdirectory': directory,
+            'outputformat': output_format, 'site': 1, 'incremental': False, 'resume': False,
+            'pageworkers': self.OPTIONS.pageworkers, 'sharddays': self.OPTIONS.sharddays, 'shardworkers': self.OPTIONS.shardworkers,
+            'processes': self.OPTIONS.processes, 'ratelimit': self.OPTIONS.ratelimit, 'cachefile': '', 'cachesize': 10000, 'cachettl': 86400,
+        }
+        # hide the progress dots and messages of ChecklistAnswers
+        with contextlib.redirect_stdout(io.StringIO()):
+            exporter = checklist_answers.ChecklistAnswers(config)
+            exporter.METRICS.addHook(hook)
+            with exporter.L2L:
+                try:
+                    exporter.chooseSite()
+                    exporter.STARTDATE = mock_server.MockData.START
+                    exporter.ENDDATE = mock_server.MockData.START + datetime.timedelta(days=self.OPTIONS.days)
+                    exporter.exportAnswersToCSV()
+                finally:
+                    exporter.CACHE.close()
+                    exporter.LOGGER.close()
+        print('  {} is {:.1f} MB'.format(os.path.basename(exporter.CSVFILENAME), os.path.getsize(exporter.CSVFILENAME) / 1000000))
+        return self.OPTIONS.checklists, exporter.METRICS
+
+    def report(self):
+        '''Prints a table of the results.'''
+
+        print()
+        print(' '.join('{:>{}}'.format(header, len(format.format(0 if key != 'name' else ''))) if key != 'name' else '{:<28}'.format(header)
+                       for key, header, format in self.COLUMNS))
+        for result in self.RESULTS:
+            print(' '.join(format.format(result[key]) if result[key] is not None else '{:>{}}'.format('-', len(format.format(0)))
+                           for key, header, format in self.COLUMNS))
+        print()
+
+    def compare(self, filename):
+        '''Prints the change in items per second and peak memory of each result compared to the results saved in a previous --json file.'''
+
+        with open(filename) as file:
+            baseline = {result['name']: result for result in json.load(file)['results']}
+
+        print('Compared to {}:'.format(filename))
+        for result in self.RESULTS:
+            if result['name'] not in baseline:
+                print('  {:<28} not in the baseline'.format(result['name']))
+                continue
+            before = baseline[result['name']]
+            speed = (result['itemspersecond'] / before['itemspersecond'] - 1) * 100 if before['itemspersecond'] else 0.0
+            line = '  {:<28} {:+.1f}% items/s'.format(result['name'], speed)
+            if result['peakmemory'] is not None and before['peakmemory']:
+                line += ', {:+.1f}% peak memory'.format((result['peakmemory'] / before['peakmemory'] - 1) * 100)
+            print(line)
+
+        return None
+
+    def percentile(self, values, fraction):
+        '''Returns the value the given fraction of the sorted values are at or below. None if there are no values.'''
+
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    def splitNumbers(self, text):
+        '''Turns a comma separated list of numbers into a list of ints. e.g. "1,4,8" -> [1, 4, 8]'''
+
+        return [int(number) for number in text.split(',')]
+
+
+def parseOptions(args=None):
+    '''Parses the command line options of the benchmark.'''
+
+    parser = argparse.ArgumentParser(description='Measures L2LApi and ChecklistAnswers against a local mock CloudDISPATCH server.')
+    server = parser.add_argument_group('mock server')
+    server.add_argument('--checklists', type=int, default=5000, help='the number of checklists to serve. default: 5000')
+    server.add_argument('--days', type=int, default=60, help='the number of days the checklists are closed over. default: 60')
+    server.add_argument('--answers', type=int, default=10, help='the number of plain tasks per checklist. each also has 4 table answers. default: 10')
+    server.add_argument('--text-size', type=int, default=40, help='the number of characters in each question and answer. default: 40')
+    server.add_argument('--lookups', type=int, default=200, help='the number of areas, lines, machines and products. default: 200')
+    server.add_argument('--latency', type=float, default=0.02, help='the seconds each request waits before it is answered. default: 0.02')
+    server.add_argument('--max-limit', type=int, default=1000, help='the largest page the server returns. default: 1000')
+    server.add_argument('--rate429', type=float, default=0.0, help='the fraction of requests answered with a 429. default: 0')
+    server.add_argument('--retry-after', type=int, default=0, help='the Retry-After seconds sent with each 429. default: 0')
+    client = parser.add_argument_group('benchmarks')
+    client.add_argument('--benchmarks', default='getall,lookups,export', help='the benchmarks to run. default: getall,lookups,export')
+    client.add_argument('--limit', type=int, default=500, help='the page size of getall. default: 500')
+    client.add_argument('--workers', default='1,4', help='the numbers of page workers to run getall with. default: 1,4')
+    client.add_argument('--lookup-calls', type=int, default=20000, help='the number of lookups per lookups run. default: 20000')
+    client.add_argument('--formats', default='csv', help='the output formats to export. default: csv')
+    client.add_argument('--pageworkers', type=int, default=4, help='the "pageworkers" setting of the export. default: 4')
+    client.add_argument('--shardworkers', type=int, default=4, help='the "shardworkers" setting of the export. default: 4')
+    client.add_argument('--sharddays', type=int, default=7, help='the "sharddays" setting of the export. default: 7')
+    client.add_argument('--processes', type=int, default=0, help='the "processes" setting of the export. default: 0')
+    client.add_argument('--ratelimit', type=float, default=None, help='the API calls per second allowed by the rate limiter. default: no limit, like config.json')
+    client.add_argument('--no-memory', dest='memory', action='store_false', help='do not measure memory. tracemalloc slows Python down.')
+    report = parser.add_argument_group('report')
+    report.add_argument('--json', help='save the results to this .json file')
+    report.add_argument('--compare', help='compare the results to a .json file saved by a previous run')
+    return parser.parse_args(args)
+
+
+# automatically run the benchmark. the check for __main__ keeps the spawned server and decoding processes from running it again.
+if __name__ == '__main__':
+    Benchmark(parseOptions()).main()
@@ -0,0 +1,240 @@
+import bisect, datetime, json, multiprocessing, random, threading, time, urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class MockData:
+    '''Generates the synthetic records served by MockServer. Each record is built from its id, so the same settings always give the same data.
+    Checklists are closed at even intervals over a number of days from 2020-01-01, in id order, and last updated an hour after they were closed.'''
+
+    START = datetime.datetime(2020, 1, 1)
+    # the lookup APIs. each has the same number of records.
+    LOOKUPS = ('areas', 'lines', 'machines', 'productcomponents')
+
+    def __init__(self, checklists=10000, days=90, answers=10, text_size=40, lookups=200, sites=3):
+        '''Sets up the MockData class.
+        Variables:
+            checklists : The number of checklists. defaults to 10000
+            days : The number of days the checklists are closed over. defaults to 90
+            answers : The number of plain tasks on each checklist. Each checklist also has a table of 2x2 cells, so it has answers + 4 answers. defaults to 10
+            text_size : The number of characters in each question and answer text. Sets the size of the checklist pages. defaults to 40
+            lookups : The number of areas, lines, machines and products. defaults to 200
+            sites : The number of sites. defaults to 3'''
+
+        self.CHECKLISTS = checklists
+        self.ANSWERS = answers
+        self.TEXTSIZE = text_size
+        self.LOOKUPSIZE = lookups
+        self.SITES = sites
+        # the closed and last updated date of each checklist, in id order, so date filters can be answered with a binary search
+        step = days * 86400 / max(1, checklists)
+        self.CLOSEDDATES = [(self.START + datetime.timedelta(seconds=int(i * step))).strftime('%Y-%m-%d %H:%M:%S') for i in range(checklists)]
+        self.UPDATEDDATES = [(self.START + datetime.timedelta(seconds=int(i * step) + 3600)).strftime('%Y-%m-%d %H:%M:%S') for i in range(checklists)]
+
+    def ids(self, endpoint, query):
+        '''Returns the ids of the records of an endpoint that match the filters of a query, in id order. Returns None for an unknown endpoint.
+        Supports id, id__in, id__gt, and the __gte, __gt, __lt and __lte filters of closeddate and lastupdated.'''
+
+        if endpoint == 'checklists':
+            low, high = 0, self.CHECKLISTS
+            for field, dates in (('closeddate', self.CLOSEDDATES), ('lastupdated', self.UPDATEDDATES)):
+                if field + '__gte' in query:
+                    low = max(low, bisect.bisect_left(dates, query[field + '__gte']))
+                if field + '__gt' in query:
+                    low = max(low, bisect.bisect_right(dates, query[field + '__gt']))
+                if field + '__lt' in query:
+                    high = min(high, bisect.bisect_left(dates, query[field + '__lt']))
+                if field + '__lte' in query:
+                    high = min(high, bisect.bisect_right(dates, query[field + '__lte']))
+            if 'id__gt' in query:
+                low = max(low, int(query['id__gt']))
+            ids = range(low + 1, high + 1)
+        elif endpoint == 'sites':
+            ids = range(1, self.SITES + 1)
+        elif endpoint in self.LOOKUPS:
+            ids = range(1, self.LOOKUPSIZE + 1)
+        else:
+            return None
+
+        if 'id' in query:
+            return [int(query['id'])] if int(query['id']) in ids else []
+        if 'id__in' in query:
+            return [int(id) for id in query['id__in'].split(',') if int(id) in ids]
+        return ids
+
+    def record(self, endpoint, id):
+        '''Returns the record of an endpoint with the given id.'''
+
+        if endpoint == 'checklists':
+            return self.checklist(id)
+        if endpoint == 'sites':
+            return {'site': id, 'description': 'Site {}'.format(id)}
+        return {'id': id, 'site': 1, 'code': '{}{}'.format(endpoint[:2].upper(), id), 'description': self.text('{} {}'.format(endpoint, id))}
+
+    def checklist(self, id):
+        '''Returns a checklist with its tasks and answers, shaped like the /checklists/ API.'''
+
+        tasks = [{'text': self.text('Question {}'.format(number)), 'table': None} for number in range(1, self.ANSWERS + 1)]
+        tasks.append({'text': 'Table', 'table': {'rows': [{'columns': [{'text': self.text('Cell {} {}'.format(row, column))} for column in (1, 2)]} for row in (1, 2)]}})
+        answers = [self.answer(id, number, None, None) for number in range(1, self.ANSWERS + 1)]
+        answers.extend(self.answer(id, self.ANSWERS + 1, row, column) for row in (1, 2) for column in (1, 2))
+        return {
+            'id': id, 'document': 1 + id % 20, 'name': 'Document {}'.format(1 + id % 20), 'number': str(id), 'created': self.CLOSEDDATES[id - 1],
+            'lastupdated': self.UPDATEDDATES[id - 1], 'lastupdatedby': 'user{}'.format(id % 10), 'closed': True, 'closeddate': self.CLOSEDDATES[id - 1],
+            'dispatch': None, 'area': 1 + id % self.LOOKUPSIZE, 'line': 1 + (id * 7) % self.LOOKUPSIZE, 'machine': 1 + (id * 13) % self.LOOKUPSIZE,
+            'technology': None, 'product': 1 + (id * 17) % self.LOOKUPSIZE if id % 3 else None, 'product_order': None, 'build_sequence': None,
+            'tasks': tasks, 'answers': answers,
+        }
+
+    def answer(self, id, task_number, row, column):
+        '''Returns one answer of a checklist. Numbers are sent as strings by the API, so some are strings here too.'''
+
+        return {
+            'task_number': str(task_number), 'table_row_number': row, 'table_column_number': None if column is None else str(column), 'na': False,
+            'answer': self.text('Answer {} {}'.format(id, task_number)) if task_number % 2 else task_number * 1.5, 'created': self.CLOSEDDATES[id - 1],
+            'lastupdatedby': 'user{}'.format(id % 10), 'control_limit_low': 1 if task_number % 2 == 0 else None,
+            'control_limit_high': 2 * task_number if task_number % 2 == 0 else None, 'reject_limit_low': None, 'reject_limit_high': None,
+        }
+
+    def text(self, prefix):
+        '''Returns a text of text_size characters, starting with the prefix.'''
+
+        return (prefix + ' ' + 'x' * self.TEXTSIZE)[:max(self.TEXTSIZE, len(prefix))]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    '''Answers the API calls made to MockServer. Set up by serve.'''
+
+    protocol_version = 'HTTP/1.1'  # keep connections alive, like the real server
+    disable_nagle_algorithm = True  # send small responses straight away instead of waiting for the client to acknowledge the previous packet
+
+    def log_message(self, format, *args):
+        # do not print each request
+        return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.reply(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self.reply(url.path, parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()))
+
+    def reply(self, path, query):
+        '''Waits for the latency, then answers with a 429 or with a page of records.'''
+
+        server = self.server
+        query = {key: values[0] for key, values in query.items()}
+        if path.rstrip('/').endswith('/stats'):
+            with server.LOCK:
+                return self.send(200, json.dumps(server.STATS).encode())
+
+        time.sleep(server.LATENCY)
+        with server.LOCK:
+            server.STATS['requests'] += 1
+            throttle = server.RANDOM.random() < server.RATE429
+            if throttle:
+                server.STATS['throttled'] += 1
+        if throttle:
+            return self.send(429, b'', {'Retry-After': str(server.RETRYAFTER)})
+
+        endpoint = path.split('/api/1.0/', 1)[-1].strip('/')
+        if endpoint == 'dispatches/open':
+            body = json.dumps({'success': True, 'data': [{'id': server.STATS['requests'], **query}]}).encode()
+            return self.send(200, body)
+        ids = server.DATA.ids(endpoint, query)
+        if ids is None:
+            return self.send(404, json.dumps({'success': False, 'error': 'Unknown API call: ' + endpoint}).encode())
+
+        limit = min(int(query.get('limit', 1)), server.MAXLIMIT)
+        offset = int(query.get('offset', 0))
+        body = json.dumps({'success': True, 'data': [server.DATA.record(endpoint, id) for id in ids[offset:offset + limit]]}).encode()
+        with server.LOCK:
+            server.STATS['bytes'] += len(body)
+        return self.send(200, body)
+
+    def send(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return None
+
+
+def serve(options, ready):
+    '''Runs the mock server until the process is stopped. Sends the port it listens on to the ready queue. See MockServer for the options.'''
+
+    server = ThreadingHTTPServer(('127.0.0.1', options.get('port', 0)), MockHandler)
+    server.daemon_threads = True
+    server.DATA = MockData(**{key: options[key] for key in ('checklists', 'days', 'answers', 'text_size', 'lookups', 'sites') if key in options})
+    server.LATENCY = options.get('latency', 0.02)
+    server.MAXLIMIT = options.get('max_limit', 1000)
+    server.RATE429 = options.get('rate429', 0.0)
+    server.RETRYAFTER = options.get('retry_after', 0)
+    server.RANDOM = random.Random(options.get('seed', 1))
+    server.STATS = {'requests': 0, 'throttled': 0, 'bytes': 0}
+    server.LOCK = threading.Lock()
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class MockServer:
+    '''A local stand-in for a CloudDISPATCH server, serving synthetic checklists, sites, areas, lines, machines and productcomponents, and accepting
+    dispatches/open. Runs in its own process, so building the responses does not compete with the code being measured for the GIL.
+
+    Sample usage:
+    with MockServer(checklists=5000, latency=0.05, rate429=0.01) as server:
+        l2l = L2LApi(server.URL, 'key')
+        checklists = l2l.doGetAll('checklists', {'site': 1})
+        print(server.stats())'''
+
+    def __init__(self, **options):
+        '''Sets up the MockServer class.
+        Variables:
+            checklists, days, answers, text_size, lookups, sites : The records to serve. See MockData
+            latency : The number of seconds each request waits before it is answered. defaults to 0.02
+            max_limit : The largest page the server returns, whatever limit is asked for. defaults to 1000
+            rate429 : The fraction of requests answered with a 429 status. e.g. 0.05. defaults to 0
+            retry_after : The value of the Retry-After header sent with each 429, in seconds. defaults to 0
+            seed : The seed of the random numbers that choose which requests get a 429. defaults to 1
+            port : The port to listen on. defaults to a free port'''
+
+        self.OPTIONS = options
+        self.PROCESS = None
+        self.URL = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        '''Starts the server process, and returns the URL of its API once it is listening. e.g. http://127.0.0.1:50123/api/1.0/'''
+
+        # spawn instead of fork, so the server does not inherit the threads of this process
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        self.PROCESS = context.Process(target=serve, args=(self.OPTIONS, ready), daemon=True)
+        self.PROCESS.start()
+        self.URL = 'http://127.0.0.1:{}/api/1.0/'.format(ready.get(timeout=60))
+        return self.URL
+
+    def stats(self):
+        '''Returns the number of requests, 429s and response bytes served so far. e.g. {"requests": 120, "throttled": 3, "bytes": 5123456}'''
+
+        with urllib.request.urlopen(self.URL + 'stats') as response:
+            return json.loads(response.read())
+
+    def stop(self):
+        '''Stops the server process.'''
+
+        if self.PROCESS is not None:
+            self.PROCESS.terminate()
+            self.PROCESS.join()
+            self.PROCESS = None
@@ -0,0 +1,187 @@
+import csv, gzip, json
+try:
+    import zstandard  # only needed for .zst output
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow, pyarrow.parquet  # only needed for .parquet output
+except ImportError:
+    pyarrow = None
+
+
+# the output formats makeWriter accepts. the format is also the file extension.
+FORMATS = ('csv', 'csv.gz', 'csv.zst', 'jsonl', 'jsonl.gz', 'jsonl.zst', 'parquet')
+# the output formats that can be appended to after a failed run. compressed and parquet files cannot be cut back to the last complete row.
+APPENDABLE = ('csv', 'jsonl')
+
+
+def makeWriter(output_format, filename, field_names, field_types=None, dictionary_fields=None, append=False):
+    '''Creates a writer for one of the FORMATS.
+    Variables:
+        output_format : One of the FORMATS. e.g. csv.gz
+        filename : The full path of the output file. e.g. checklist.csv.gz
+        field_names : The list of headers, in order
+        field_types : Parquet only. See ParquetWriter
+        dictionary_fields : Parquet only. See ParquetWriter
+        append : Set to True to add rows to the end of an existing file instead of replacing it. Only for the APPENDABLE formats'''
+
+    if output_format not in FORMATS:
+        raise ValueError('Unknown output format "{}". Use one of: {}'.format(output_format, ', '.join(FORMATS)))
+    if append and output_format not in APPENDABLE:
+        raise ValueError('Cannot append to "{}" files. Use one of: {}'.format(output_format, ', '.join(APPENDABLE)))
+
+    compression = output_format.split('.')[1] if '.' in output_format else None
+    if output_format.startswith('csv'):
+        return CSVWriter(filename, field_names, compression, append)
+    if output_format.startswith('jsonl'):
+        return JSONLWriter(filename, field_names, compression, append)
+    return ParquetWriter(filename, field_names, field_types, dictionary_fields)
+
+
+def openText(filename, compression=None, append=False):
+    '''Opens a text file for writing, or for appending if requested, compressed with gzip ('gz') or zstandard ('zst') if requested.'''
+
+    mode = 'a' if append else 'w'
+    if compression == 'gz':
+        return gzip.open(filename, mode + 't', newline='', encoding='utf-8')
+    if compression == 'zst':
+        if zstandard is None:
+            raise ImportError('.zst output requires the zstandard package. Install it with: pip install zstandard')
+        return zstandard.open(filename, mode + 't', newline='', encoding='utf-8')
+    if compression is not None:
+        raise ValueError('Unknown compression "{}"'.format(compression))
+    return open(filename, mode, newline='', encoding='utf-8')
+
+
+class CSVWriter:
+    '''Writes rows to a .csv spreadsheet, optionally gzip or zstandard compressed. Strings are quoted, numbers are not.'''
+
+    def __init__(self, filename, field_names, compression=None, append=False):
+        '''Sets up the CSVWriter class, creates the file and writes the headers.
+        Variables:
+            filename : The full path of the file
+            field_names : The list of headers, in order
+            compression : None, 'gz' or 'zst'. defaults to None
+            append : Set to True to add rows to the end of an existing file. The headers are only written if the file is empty.'''
+
+        self.FILENAME = filename
+        self.FIELDNAMES = field_names
+        self.FILE = openText(filename, compression, append)
+        self.WRITER = csv.writer(self.FILE, quoting=csv.QUOTE_NONNUMERIC, delimiter=',', quotechar='"')
+        if not append or self.FILE.tell() == 0:
+            self.WRITER.writerow(field_names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def writeRows(self, rows):
+        '''Writes a list of rows. Each row is a tuple of values in the order of the headers.'''
+
+        self.WRITER.writerows(rows)
+
+    def flush(self):
+        '''Writes everything written so far to the disk.'''
+
+        self.FILE.flush()
+
+    def close(self):
+        '''Finishes and closes the file.'''
+
+        self.FILE.close()
+
+
+class JSONLWriter(CSVWriter):
+    '''Writes rows to a .jsonl file, one JSON object per line, optionally gzip or zstandard compressed.'''
+
+    def __init__(self, filename, field_names, compression=None, append=False):
+        '''Sets up the JSONLWriter class and creates the file.
+        Variables:
+            filename : The full path of the file
+            field_names : The list of fields, in order
+            compression : None, 'gz' or 'zst'. defaults to None
+            append : Set to True to add rows to the end of an existing file'''
+
+        self.FILENAME = filename
+        self.FIELDNAMES = field_names
+        self.FILE = openText(filename, compression, append)
+
+    def writeRows(self, rows):
+        '''Writes a list of rows. Each row is a tuple of values in the order of the fields.'''
+
+        field_names = self.FIELDNAMES
+        self.FILE.write(''.join(json.dumps(dict(zip(field_names, row)), default=str) + '\n' for row in rows))
+
+
+class ParquetWriter:
+    '''Writes rows to a .parquet file in row groups of batch_size rows. Fields that repeat the same few values over many rows, like the checklist
+    fields copied onto each answer, are dictionary encoded, so each value is only stored once per row group. Requires the pyarrow package.'''
+
+    # the pyarrow types field_types can use, and how a value is converted to each
+    TYPES = {
+        'string': (lambda: pyarrow.string(), str),
+        'int64': (lambda: pyarrow.int64(), int),
+        'float64': (lambda: pyarrow.float64(), float),
+        'bool': (lambda: pyarrow.bool_(), bool),
+    }
+
+    def __init__(self, filename, field_names, field_types=None, dictionary_fields=None, batch_size=50000):
+        '''Sets up the ParquetWriter class and creates the file.
+        Variables:
+            filename : The full path of the file
+            field_names : The list of fields, in order
+            field_types : An object of the type of each field: string, int64, float64 or bool. e.g. {"checklist_id": "int64"}. Fields not listed are strings.
+            dictionary_fields : The list of fields to dictionary encode. defaults to all string fields
+            batch_size : The number of rows in each row group. defaults to 50000'''
+
+        if pyarrow is None:
+            raise ImportError('.parquet output requires the pyarrow package. Install it with: pip install pyarrow')
+
+        field_types = field_types or {}
+        self.FILENAME = filename
+        self.FIELDNAMES = field_names
+        self.BATCHSIZE = batch_size
+        self.CONVERTERS = [self.TYPES[field_types.get(name, 'string')][1] for name in field_names]
+        self.SCHEMA = pyarrow.schema([(name, self.TYPES[field_types.get(name, 'string')][0]()) for name in field_names])
+        if dictionary_fields is None:
+            dictionary_fields = [name for name in field_names if field_types.get(name, 'string') == 'string']
+        self.WRITER = pyarrow.parquet.ParquetWriter(filename, self.SCHEMA, use_dictionary=list(dictionary_fields), compression='zstd')
+        self.COLUMNS = [[] for _ in field_names]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def writeRows(self, rows):
+        '''Adds a list of rows to the current row group, and writes the row group once it has batch_size rows. Each row is a tuple of values in the
+        order of the fields. None and empty strings are stored as nulls in fields that are not strings.'''
+
+        if not rows:
+            return None
+        # turn the rows into columns, and convert each column to its type
+        for column, values, convert in zip(self.COLUMNS, zip(*rows), self.CONVERTERS):
+            if convert is str:
+                column.extend(None if value is None else str(value) for value in values)
+            else:
+                column.extend(None if value is None or value == '' else convert(value) for value in values)
+        if len(self.COLUMNS[0]) >= self.BATCHSIZE:
+            self.flush()
+
+    def flush(self):
+        '''Writes the rows added so far as a row group.'''
+
+        if self.COLUMNS[0]:
+            self.WRITER.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type) for column, type in zip(self.COLUMNS, self.SCHEMA.types)], schema=self.SCHEMA))
+            self.COLUMNS = [[] for _ in self.FIELDNAMES]
+
+    def close(self):
+        '''Writes the last row group, and finishes and closes the file.'''
+
+        self.flush()
+        self.WRITER.close()
@@ -1,30 +1,135 @@
 import os, sys
 # add the parent directory to the system path to use shared config and l2l_api module. Can put the l2l_api file in the same directory as this file as well.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
-import l2l_api, csv, json, datetime, dateutil
+import l2l_api, answer_writers, csv, json, datetime, dateutil, queue, threading, concurrent.futures, multiprocessing
 from dateutil import parser
 
 # change directory so the .csv file and log file will be saved in the same directory as this file. Can change the save location in the config.json file.
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
 
+def buildQuestionIndex(tasks):
+    '''Returns the question text of every task and table cell of a checklist, keyed by (task_number, table_row_number, table_column_number).
+    Numbers start at 1. Tasks are keyed by (task_number, None, None).'''
+
+    index = {}
+    for task_number, task in enumerate(tasks, 1):
+        index[(task_number, None, None)] = task.get('text')
+        table = task.get('table')
+        if table:
+            for row_number, row in enumerate(table['rows'], 1):
+                for column_number, column in enumerate(row['columns'], 1):
+                    index[(task_number, row_number, column_number)] = column['text']
+    return index
+
+
+def flattenAnswers(checklist):
+    '''Returns the answers of a checklist as a list of tuples, one per answer, in the order of the answer fields of ChecklistAnswers.FIELDNAMES
+    (question, answer_na, answer, ...). The question text is found through an index built once per checklist, instead of walking the tasks per answer.'''
+
+    if not checklist['answers']:
+        return []
+
+    index = buildQuestionIndex(checklist['tasks'])
+    rows = []
+    append = rows.append
+    # dataset contains one record per checklist answer, even if the answer is inside a table.
+    for answer in checklist['answers']:
+        # if the answer is part of a table, pull the question text of the table cell
+        if answer['table_row_number'] is not None and answer['table_column_number'] is not None:
+            question = index[(int(answer['task_number']), int(answer['table_row_number']), int(answer['table_column_number']))]
+        # question was not inside a table
+        else:
+            question = index[(int(answer['task_number']), None, None)]
+        append((
+            question, answer['na'], answer['answer'], answer['created'], answer['lastupdatedby'],
+            answer['control_limit_low'], answer['control_limit_high'], answer['reject_limit_low'], answer['reject_limit_high'],
+        ))
+    return rows
+
+
+def decodeChecklists(content, limit):
+    '''Decodes a raw page of the /checklists/ API and flattens the answers of each checklist. Runs in the process pool when "processes" is set in
+    the config. Returns the checklists without their tasks and answers, each with an "answer_rows" list of flattenAnswers tuples instead, so only
+    the values the writer needs are sent back to the main process. Checklists whose tasks are a string are returned as they are, to be skipped.'''
+
+    checklists = l2l_api.decodeResult(content, limit) or []
+    if isinstance(checklists, dict):
+        checklists = [checklists]
+
+    decoded = []
+    for checklist in checklists:
+        if isinstance(checklist['tasks'], str):
+            decoded.append(checklist)
+            continue
+        checklist['answer_rows'] = flattenAnswers(checklist)
+        checklist['tasks'] = checklist['answers'] = None
+        decoded.append(checklist)
+    return decoded
+
+
 class ChecklistAnswers:
     '''Creates a .csv spreadsheet of checklist answers from a single site over a date range.
     
     Sample script usage:
     $ python3 checklist_answers.py
     
-    User will be prompted for the site and start and end dates.'''
-
-    def __init__(self):
-        '''Sets up all the class variables.'''
-
-        # Set the CONFIG object from the config.json file
-        self.CONFIG = None
-        self.loadConfig()
-
-        # set the L2L API class
-        self.L2L = l2l_api.L2LApi(self.CONFIG['apiurl'], self.CONFIG['apikey'], self.CONFIG['verbose'])
+    User will be prompted for the site and start and end dates. Long date ranges are split into shards of "sharddays" days, and "shardworkers"
+    shards are downloaded at the same time. Set "processes" to decode and flatten the downloaded pages in that many processes.
+
+    Set "resume" to true in the config.json file to carry on with the last unfinished export of the site instead of starting a new one.
+
+    Set "incremental" to true in the config.json file to keep a single .csv spreadsheet up to date instead. Each run only downloads the checklists
+    closed or changed since the previous run, and replaces their answers in the spreadsheet. Set "site" to skip the site prompt, e.g. for scheduled runs.'''
+
+    # the headers of the .csv file
+    FIELDNAMES = ['checklist_id', 'document_id', 'document_name', 'checklist_number', 'checklist_created', 'checklist_updated', 'checklist_udpated_by', 'checklist_closed', 'checklist_closed_date', 'dispatch_number', 'area_id', 'area_code', 'area_description', 'line_id', 'line_code', 'line_description', 'machine_id', 'machine_code', 'machine_description', 'technology_id', 'product_id', 'product_code', 'product_description', 'product_order_id', 'build_sequence_id', 'question', 'answer_na', 'answer', 'answer_created', 'answer_by', 'control_limit_low', 'control_limit_high', 'reject_limit_low', 'reject_limit_high']
+    # the type of each non-string field in .parquet files
+    FIELDTYPES = {'checklist_id': 'int64', 'document_id': 'int64', 'checklist_closed': 'bool', 'area_id': 'int64', 'line_id': 'int64', 'machine_id': 'int64', 'technology_id': 'int64', 'product_id': 'int64', 'product_order_id': 'int64', 'build_sequence_id': 'int64', 'answer_na': 'bool', 'control_limit_low': 'float64', 'control_limit_high': 'float64', 'reject_limit_low': 'float64', 'reject_limit_high': 'float64'}
+    # the fields copied from the checklist onto each of its answers. dictionary encoded in .parquet files.
+    DOCUMENTFIELDS = FIELDNAMES[:25]
+    # checklist fields that are looked up by id, and the API used to look them up
+    LOOKUPS = (('area', 'areas'), ('line', 'lines'), ('machine', 'machines'), ('product', 'productcomponents'))
+    # the number of ids to look up in a single bulk API call
+    LOOKUPBATCHSIZE = 100
+    # the number of rows handed to the output writer at once
+    WRITEBATCHSIZE = 10000
+    # the number of pages each date range shard can fetch ahead of the spreadsheet writer
+    SHARDQUEUESIZE = 4
+    # the number of times a checklist that could not be read is fetched again at the end of the export
+    REFETCHATTEMPTS = 3
+
+    def __init__(self, config=None):
+        '''Sets up all the class variables.
+        Variables:
+            config : Optional object of configuration settings to use instead of the config.json file, e.g. for benchmarks. Has the same settings as config.json'''
+
+        # Set the CONFIG object from the config.json file, unless one was provided
+        self.CONFIG = dict(config) if config is not None else None
+        if self.CONFIG is None:
+            self.loadConfig()
+
+        # set the cache used for area, line, machine and product lookups. keep it in a file between runs if 'cachefile' is set in the config.
+        cache_size = self.CONFIG.get('cachesize') or None
+        cache_ttl = self.CONFIG.get('cachettl') or None
+        if self.CONFIG.get('cachefile'):
+            self.CACHE = l2l_api.SQLiteCache(self.CONFIG['cachefile'], self.CONFIG['apiurl'], cache_size, cache_ttl)
+        else:
+            self.CACHE = l2l_api.MemoryCache(cache_size, cache_ttl)
+
+        # set the L2L API class. keep one pooled connection per page worker of each shard.
+        self.PAGEWORKERS = max(1, int(self.CONFIG.get('pageworkers', 1)))
+        self.SHARDWORKERS = max(1, int(self.CONFIG.get('shardworkers', 1)))
+        self.SHARDDAYS = self.CONFIG.get('sharddays') or 31
+        self.PROCESSES = int(self.CONFIG.get('processes') or 0)
+        self.PROCESSPOOL = None
+        # all requests share one rate limiter, which slows down when the server answers 429. no limit until then, unless "ratelimit" is set.
+        self.LIMITER = l2l_api.RateLimiter(self.CONFIG.get('ratelimit') or None)
+        # this class and the L2L API class write to the same log file from a background thread, so logging does not slow down the download
+        self.LOGGER = l2l_api.LogWriter()
+        # record the latency, size, retries and pages of every request. a summary is logged at the end of main.
+        self.METRICS = l2l_api.Metrics(logger=self.LOGGER)
+        self.L2L = l2l_api.L2LApi(self.CONFIG['apiurl'], self.CONFIG['apikey'], self.CONFIG['verbose'], pool_maxsize=max(10, self.PAGEWORKERS * self.SHARDWORKERS), cache=self.CACHE, rate_limiter=self.LIMITER, metrics=self.METRICS, logger=self.LOGGER)
 
         # set the log and csv directires. create if needed.
         current_path = os.path.dirname(os.path.realpath(__file__))
@@ -47,25 +152,45 @@ class ChecklistAnswers:
         self.ENDDATE = None
         self.STARTDATE = None
         self.LOGFILENAME = os.path.join(self.CONFIG['logdirectory'], 'log-' + self.getCurrentDateTimeStrForFilename() + '.log')
-        self.CSVFILENAME = os.path.join(self.CONFIG['csvdirectory'], 'checklist-' + self.getCurrentDateTimeStrForFilename() + '.csv')
+        self.OUTPUTFORMAT = self.CONFIG.get('outputformat') or 'csv'
+        self.CSVFILENAME = os.path.join(self.CONFIG['csvdirectory'], 'checklist-' + self.getCurrentDateTimeStrForFilename() + '.' + self.OUTPUTFORMAT)
+        self.INCREMENTAL = bool(self.CONFIG.get('incremental'))
+        self.RESUME = bool(self.CONFIG.get('resume'))
+        self.CHECKPOINT = None  # the checkpoint of the export being resumed, see loadCheckpoint
+        self.REFETCH = []  # the ids of the checklists that could not be read, to fetch again at the end of the export
+        self.LOGGER.setFilename(self.LOGFILENAME)
         self.log('log file: {}\ncsv file: {}'.format(self.LOGFILENAME, self.CSVFILENAME))
-        
-        self.L2L.setLogFilename(self.LOGFILENAME)
         return None
 
     def main(self):
         '''Run the application. User will be prompted to choose a site and a date range, then the CSV sheet will be created'''
 
-        # choose a site. if no site is selected, stop the process.
-        if not self.chooseSite():
-            return None
-
-        # choose a date range. if an invalid date range is provided, stop the process.
-        if not self.chooseDateRange():
-            return None
-
-        # export answers to a .csv spreadsheet.
-        self.exportAnswersToCSV()
+        # close the pooled connections to the L2L server, the cache and the log file once the export is done, even if it fails part way
+        with self.L2L:
+            try:
+                # choose a site. if no site is selected, stop the process.
+                if not self.chooseSite():
+                    return None
+
+                # incremental mode. update the spreadsheet with the checklists changed since the last run.
+                if self.INCREMENTAL:
+                    with self.METRICS.span('incremental export', site=self.SITE['site']):
+                        self.exportIncrementalCSV()
+                    return None
+
+                # resume the last unfinished export of the site if "resume" is set. otherwise choose a date range. if an invalid date range is provided, stop the process.
+                if not self.loadCheckpoint() and not self.chooseDateRange():
+                    return None
+
+                # export answers to a .csv spreadsheet.
+                with self.METRICS.span('export', site=self.SITE['site']):
+                    self.exportAnswersToCSV()
+            finally:
+                # log what the export cost, per endpoint, to help tune the workers, the rate limit and the cache size
+                if self.METRICS.ENDPOINTS:
+                    self.log('\n' + self.METRICS.summary(self.CACHE), True)
+                self.CACHE.close()
+                self.LOGGER.close()
 
     def loadConfig(self):
         '''Loads the configuration settings into the app. Can create a config-dev.json file for development purposes, and remove it before deployment.'''
@@ -88,16 +213,20 @@ class ChecklistAnswers:
             self.CONFIG = json.load(config)
 
     def chooseSite(self):
-        '''Pulls a list of sites from the L2L server, and prompts the user to enter a Site ID'''
+        '''Pulls a list of sites from the L2L server, and prompts the user to enter a Site ID. Uses the "site" setting in the config file instead, if it is set.'''
 
-        # get a list of sites from the server and display them on screen
+        # get a list of sites from the server
         sites = self.L2L.doGet('sites', {'order_by':'site'}, 1000)
-        print('SITES:')
-        for site in sites:
-            print('{}: {}'.format(site['site'], site['description']))
 
-        # prompt the user to enter a site id
-        user_site_id = int(input('Please enter a site number from above: '))
+        # use the site from the config file
+        if self.CONFIG.get('site'):
+            user_site_id = int(self.CONFIG['site'])
+        # display the sites on screen, prompt the user to enter a site id
+        else:
+            print('SITES:')
+            for site in sites:
+                print('{}: {}'.format(site['site'], site['description']))
+            user_site_id = int(input('Please enter a site number from above: '))
 
         # find the site the user entered, store it.
         for site in sites:
@@ -107,6 +236,9 @@ class ChecklistAnswers:
 
         # if the user entered a bad site id, retry
         if self.SITE == None:
+            if self.CONFIG.get('site'):
+                self.log('ERROR: The site in the config file is not a valid site id.', True)
+                return False
             self.log('ERROR: Not a valid site id. Please try again.', True)
             return self.chooseSite()
         
@@ -116,7 +248,7 @@ class ChecklistAnswers:
         return True
 
     def chooseDateRange(self):
-        '''Prompts the user to choose a start and end date. Limit the date range to 31 days (one month).'''
+        '''Prompts the user to choose a start and end date.'''
 
         # prompt the user for a start and end date
         start_date = input('Please enter the start date: ')
@@ -131,17 +263,12 @@ class ChecklistAnswers:
             self.log('ERROR: One of the dates was not valid. Please try again.', True)
             return self.chooseDateRange()
 
-        # verify the date is 
-        if (self.ENDDATE - self.STARTDATE).total_seconds() >= 31 * 24 * 60 * 60:
-            self.log('ERROR: You can only select one month at a time. Please try again.', True)
-            return self.chooseDateRange()
-
         self.log('Start date: {}, End date: {}'.format(self.makeDateString(self.STARTDATE), self.makeDateString(self.ENDDATE)))
 
         return True
         
     def exportAnswersToCSV(self):
-        '''Creates a .csv spreadsheet with one answer per row. Gets all checklist documents using the
+        '''Creates a .csv spreadsheet (or another "outputformat", see answer_writers.FORMATS) with one answer per row. Gets all checklist documents using the
         selected site and for the selected date range. Uses the L2L /checklists/ API, which returns one 
         record per filled out checklsit. Each checklist object contains a list of answers and a list of 
         tasks.'''
@@ -150,109 +277,401 @@ class ChecklistAnswers:
         self.log('Gathering checklist answers', True)
         start = datetime.datetime.now()
 
-        # define a list of headers for the .csv file. create the .csv file using the headers list.
-        field_names = ['checklist_id', 'document_id', 'document_name', 'checklist_number', 'checklist_created', 'checklist_updated', 'checklist_udpated_by', 'checklist_closed', 'checklist_closed_date', 'dispatch_number', 'area_id', 'area_code', 'area_description', 'line_id', 'line_code', 'line_description', 'machine_id', 'machine_code', 'machine_description', 'technology_id', 'product_id', 'product_code', 'product_description', 'product_order_id', 'build_sequence_id', 'question', 'answer_na', 'answer', 'answer_created', 'answer_by', 'control_limit_low', 'control_limit_high', 'reject_limit_low', 'reject_limit_high']
-        with open(self.CSVFILENAME, 'w', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames = field_names, quoting=csv.QUOTE_NONNUMERIC, delimiter=',', quotechar='"')
-            writer.writeheader()
-            
-            # get completed checklists 500 at a time.
-            finished = False
-            offset = 0
-            limit = 500
-            data = {'site':self.SITE['site'], 'closeddate__gte':self.L2L.makeDateString(self.STARTDATE), 'closeddate__lte':self.L2L.makeDateString(self.ENDDATE)}
-            while not finished:
-                # get the checklists from the L2L server
-                checklists = self.L2L.doGet('checklists', {**data, 'offset': offset}, limit)
-                print('.', end='')
-                if checklists is not None and len(checklists) > 0:
-                    for checklist in checklists:
-                        writer.writerows(self.formatChecklistAnswers(checklist)) # write answers to file
-                if checklists is None or len(checklists) < limit:
-                    finished = True
-                else:
-                    offset += len(checklists)
+        # decode and flatten pages in a pool of processes if "processes" is set in the config. spawn the processes instead of forking them, because
+        # this process already runs threads. pages are still handed to the writer in order.
+        if self.PROCESSES > 1:
+            self.PROCESSPOOL = concurrent.futures.ProcessPoolExecutor(self.PROCESSES, multiprocessing.get_context('spawn'))
+
+        # when resuming, start at the position of the checkpoint. cut the output file back to its size at the checkpoint, removing rows written after it.
+        position = (0, None)
+        if self.CHECKPOINT is not None:
+            position = (self.CHECKPOINT['shard'], self.CHECKPOINT['lastid'])
+            with open(self.CSVFILENAME, 'r+b') as file:
+                file.truncate(self.CHECKPOINT['size'])
+
+        try:
+            # create the output file using the headers list, in the format set by "outputformat" in the config. defaults to .csv
+            with answer_writers.makeWriter(self.OUTPUTFORMAT, self.CSVFILENAME, self.FIELDNAMES, self.FIELDTYPES, self.DOCUMENTFIELDS, append=self.CHECKPOINT is not None) as writer:
+                # stream completed checklists, so only the pages being fetched are held in memory. write answers to file in batches, and save a
+                # checkpoint after each batch.
+                rows = []
+                for position, checklist in self.iterChecklists(position):
+                    rows.extend(self.flattenChecklist(checklist))
+                    if len(rows) >= self.WRITEBATCHSIZE:
+                        writer.writeRows(rows)
+                        rows = []
+                        self.saveCheckpoint(writer, position)
+                writer.writeRows(rows)
+
+                # fetch the checklists that could not be read again, and add their answers at the end
+                writer.writeRows(self.refetchChecklists())
+                self.saveCheckpoint(writer, position)
+        finally:
+            if self.PROCESSPOOL is not None:
+                self.PROCESSPOOL.shutdown(cancel_futures=True)
+                self.PROCESSPOOL = None
+
+        # the export is finished. keep the checkpoint only if some checklists still could not be read, so a resumed run only fetches those.
+        if self.REFETCH:
+            self.log('\nWARNING: {} checklists could not be read: {}. Set "resume" to true in the config file and run again to fetch only those.'.format(len(self.REFETCH), ', '.join(str(id) for id in self.REFETCH)), True)
+        elif os.path.exists(self.CSVFILENAME + '.checkpoint.json'):
+            os.remove(self.CSVFILENAME + '.checkpoint.json')
         
         # print out the total time it took to gather checklist answers
         self.log('\nCompleted in ' + str(datetime.timedelta(seconds = (datetime.datetime.now() - start).seconds)), True)
                         
         return None
 
+    def makeShards(self):
+        '''Splits the selected date range into shards of "sharddays" days. Returns a list of /checklists/ API filters, one per shard, in date order.
+        Each shard includes its start date and excludes its end date, except the last shard, which includes the end date of the range.'''
+
+        shards = []
+        shard_start = self.STARTDATE
+        while True:
+            shard_end = shard_start + datetime.timedelta(days=self.SHARDDAYS)
+            # id order lets a resumed export carry on after the last checklist written. see iterChecklists
+            data = {'site':self.SITE['site'], 'closeddate__gte':self.L2L.makeDateString(shard_start), 'order_by':'id'}
+            if shard_end >= self.ENDDATE:
+                data['closeddate__lte'] = self.L2L.makeDateString(self.ENDDATE)
+                shards.append(data)
+                return shards
+            data['closeddate__lt'] = self.L2L.makeDateString(shard_end)
+            shards.append(data)
+            shard_start = shard_end
+
+    def iterChecklists(self, start=(0, 0)):
+        '''Yields every checklist closed in the selected date range, in shard order. Checklists are fetched 500 at a time. The next page is requested
+        while the current one is written, and several pages are fetched at once when "pageworkers" is set in the config. When "shardworkers" is set,
+        that many shards are fetched at the same time, each a few pages ahead of the writer. Checklists still arrive in order.
+        Yields (position, checklist) tuples. The position is the (shard, id) of the checklist, which a resumed export can start after.
+        Variables:
+            start : The (shard, id) position to start after. The id is None to start at the beginning of the shard. defaults to the first checklist'''
+
+        limit = 500
+        start_shard, start_id = start
+        # resume after the id of the last checklist written, not at its offset. checklists before it that are reopened or re-dated in the meantime
+        # would shift the later checklists down an offset, and one would be skipped.
+        shards = []
+        for number, data in enumerate(self.makeShards()):
+            if number == start_shard and start_id is not None:
+                data['id__gt'] = start_id
+            if number >= start_shard:
+                shards.append((number, data))
+
+        # one shard at a time. pages are handed to onPage in this thread.
+        if self.SHARDWORKERS <= 1 or len(shards) == 1:
+            def onPage(page):
+                print('.', end='')
+                self.prefetchLookups(page)
+
+            for number, data in shards:
+                for checklist in self.L2L.iterGetAll('checklists', data, limit, self.PAGEWORKERS, on_page=onPage, **self.decodeOptions()):
+                    yield (number, checklist['id']), checklist
+            return None
+
+        # several shards at a time. each shard hands its pages to the writer through its own queue. the writer reads the queues in shard order.
+        # a full queue makes its shard wait, so at most SHARDQUEUESIZE pages per shard are held in memory.
+        stop = threading.Event()
+        shard_queues = [queue.Queue(maxsize=self.SHARDQUEUESIZE) for _ in shards]
+
+        def put(pages, item):
+            # give up if the writer stopped reading
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetchShard(data, pages):
+            try:
+                if stop.is_set():
+                    return None
+                for page in self.L2L.iterGetPages('checklists', data, limit, self.PAGEWORKERS, prefetch=True, **self.decodeOptions()):
+                    self.prefetchLookups(page)
+                    if not put(pages, page):
+                        return None
+                put(pages, None) # end of the shard
+            except Exception as error:
+                put(pages, error)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.SHARDWORKERS) as executor:
+            try:
+                for (number, data), pages in zip(shards, shard_queues):
+                    executor.submit(fetchShard, data, pages)
+                for (number, data), pages in zip(shards, shard_queues):
+                    page = pages.get()
+                    while page is not None:
+                        if isinstance(page, Exception):
+                            raise page
+                        print('.', end='')
+                        for checklist in page:
+                            yield (number, checklist['id']), checklist
+                        page = pages.get()
+            finally:
+                stop.set()
+
+        return None
+
+    def loadCheckpoint(self):
+        '''Finds the newest unfinished export of the selected site in the csv directory, if "resume" is set in the config. Restores its date range,
+        output file and position, so exportAnswersToCSV carries on where it stopped. Returns True if there is an export to resume.'''
+
+        if not self.RESUME:
+            return False
+
+        # checkpoints are stored next to their output file. see saveCheckpoint
+        checkpoints = []
+        for filename in os.listdir(self.CONFIG['csvdirectory']):
+            if filename.endswith('.checkpoint.json'):
+                with open(os.path.join(self.CONFIG['csvdirectory'], filename)) as file:
+                    checkpoint = json.load(file)
+                if checkpoint['site'] == self.SITE['site'] and 'lastid' in checkpoint and os.path.exists(checkpoint['filename']):
+                    checkpoints.append(checkpoint)
+        if not checkpoints:
+            self.log('No unfinished export of this site to resume. Starting a new one.', True)
+            return False
+
+        self.CHECKPOINT = max(checkpoints, key=lambda checkpoint: checkpoint['saved'])
+        self.STARTDATE = parser.parse(self.CHECKPOINT['startdate'])
+        self.ENDDATE = parser.parse(self.CHECKPOINT['enddate'])
+        self.SHARDDAYS = self.CHECKPOINT['sharddays']
+        self.OUTPUTFORMAT = self.CHECKPOINT['outputformat']
+        self.CSVFILENAME = self.CHECKPOINT['filename']
+        self.REFETCH = self.CHECKPOINT['refetch']
+        self.log('Resuming {} after checklist {} of shard {}. Start date: {}, End date: {}'.format(self.CSVFILENAME, self.CHECKPOINT['lastid'], self.CHECKPOINT['shard'] + 1,
+            self.makeDateString(self.STARTDATE), self.makeDateString(self.ENDDATE)), True)
+
+        return True
+
+    def saveCheckpoint(self, writer, position):
+        '''Flushes the writer, and stores how far the export got in a .checkpoint.json file next to the output file: the shard and id of the last checklist,
+        the size of the output file and the checklists to fetch again. Only for the output formats that can be appended to, see answer_writers.APPENDABLE.'''
+
+        if self.OUTPUTFORMAT not in answer_writers.APPENDABLE:
+            return None
+
+        writer.flush()
+        checkpoint = {
+            'site': self.SITE['site'],
+            'startdate': self.makeDateString(self.STARTDATE),
+            'enddate': self.makeDateString(self.ENDDATE),
+            'sharddays': self.SHARDDAYS,
+            'outputformat': self.OUTPUTFORMAT,
+            'filename': self.CSVFILENAME,
+            'shard': position[0],
+            'lastid': position[1],
+            'size': os.path.getsize(self.CSVFILENAME),
+            'refetch': self.REFETCH,
+            'saved': self.makeDateString(datetime.datetime.now()),
+        }
+        # write to a temporary file first, so a failure while saving keeps the previous checkpoint
+        with open(self.CSVFILENAME + '.checkpoint.json.tmp', 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(self.CSVFILENAME + '.checkpoint.json.tmp', self.CSVFILENAME + '.checkpoint.json')
+
+        return None
+
+    def refetchChecklists(self):
+        '''Fetches the checklists that could not be read again, one at a time, up to REFETCHATTEMPTS times each. Returns the rows of the ones that
+        could be read this time, if they are still closed. The others are left in REFETCH.'''
+
+        rows = []
+        for checklist_id in list(self.REFETCH):
+            for _ in range(self.REFETCHATTEMPTS):
+                checklist = self.L2L.doGet('checklists', {'site':self.SITE['site'], 'id':checklist_id})
+                if checklist and not isinstance(checklist['tasks'], str):
+                    self.REFETCH.remove(checklist_id)
+                    # the checklist may have been reopened since it was first fetched
+                    if checklist['closed']:
+                        rows.extend(self.flattenChecklist(checklist))
+                    break
+
+        return rows
+
+    def decodeOptions(self):
+        '''Returns the options that make L2LApi.iterGetPages decode checklist pages in the process pool, if there is one. Each shard fetches ahead
+        enough pages to keep every process busy, while its page workers carry on fetching.'''
+
+        if self.PROCESSPOOL is None:
+            return {}
+        return {'decoder': decodeChecklists, 'executor': self.PROCESSPOOL, 'window': self.PAGEWORKERS + self.PROCESSES}
+
+    def exportIncrementalCSV(self):
+        '''Keeps a single .csv spreadsheet of the selected site up to date. Gets the checklists closed or changed since the last run using a watermark
+        of their lastupdated date, stored in a .json file next to the spreadsheet. The answers of each changed checklist replace its old answers in the
+        spreadsheet. Checklists that are no longer closed are removed. Checklists that cannot be read keep their old answers, and are fetched again
+        by the next run. The first run asks for the date to start from.
+        Always writes a plain .csv spreadsheet, because rows are replaced in place.'''
+
+        csv_filename = os.path.join(self.CONFIG['csvdirectory'], 'checklist-incremental-{}.csv'.format(self.SITE['site']))
+        watermark_filename = os.path.join(self.CONFIG['csvdirectory'], 'checklist-incremental-{}.json'.format(self.SITE['site']))
+
+        # the first run starts from the "startdate" in the config file, or asks for the date to start from
+        start_date = None
+        if not os.path.exists(watermark_filename):
+            try:
+                start_date = self.makeDateString(self.CONFIG.get('startdate') or input('Please enter the date to start from: '))
+            except ValueError:
+                if self.CONFIG.get('startdate'):
+                    self.log('ERROR: The startdate in the config file is not a valid date.', True)
+                    return None
+                self.log('ERROR: Not a valid date. Please try again.', True)
+                return self.exportIncrementalCSV()
+            except EOFError:
+                # no one to ask, e.g. a scheduled run
+                self.log('ERROR: No date to start from. Set "startdate" in the config file for the first run.', True)
+                return None
+        watermark = l2l_api.Watermark(watermark_filename, 'lastupdated', start=start_date)
+        # the checklists the previous run could not read. their old rows were kept, and they are fetched again below.
+        self.REFETCH = list(watermark.STATE.get('refetch', []))
+        pending = {str(id) for id in self.REFETCH}
+        self.log('Gathering checklists changed since {} into {}'.format(watermark.VALUE, csv_filename), True)
+        start = datetime.datetime.now()
+
+        # get the changed checklists, and write the answers of each one to a temporary file as its page arrives, so only the ids and lastupdated
+        # dates of the changed checklists are kept in memory. a checklist can change again while paging. only the rows of its latest version are kept.
+        def onPage(page):
+            print('.', end='')
+            self.prefetchLookups(page)
+
+        changed = {}  # the lastupdated date of the latest version of each changed checklist, e.g. {'1234': '2020-01-02 03:04:05'}
+        try:
+            with open(csv_filename + '.changed.tmp', 'w', newline='') as file:
+                writer = csv.writer(file, quoting=csv.QUOTE_NONNUMERIC, delimiter=',', quotechar='"')
+                writer.writerow(self.FIELDNAMES)
+                for checklist in self.L2L.iterGetChanged('checklists', {'site':self.SITE['site']}, watermark, 500, on_page=onPage):
+                    checklist_id = str(checklist['id'])
+                    if checklist_id in changed and checklist['lastupdated'] <= changed[checklist_id]:
+                        continue
+                    changed[checklist_id] = checklist['lastupdated']
+                    # the latest version replaces the one that could not be read. flattenChecklist adds it back if this one cannot be read either.
+                    if checklist['id'] in self.REFETCH:
+                        self.REFETCH.remove(checklist['id'])
+                    if checklist['closed']:
+                        writer.writerows(self.flattenChecklist(checklist)) # write answers to file
+
+            # fetch the checklists that could not be read again. the old rows of the ones that still cannot be read are kept, and their ids are saved
+            # with the watermark, so the next run fetches them again even though the watermark has moved past them.
+            refetched_rows = self.refetchChecklists()
+            replaced = (set(changed) | pending) - {str(id) for id in self.REFETCH}
+            watermark.STATE['refetch'] = self.REFETCH
+
+            # write the spreadsheet to a temporary file: the rows of the old spreadsheet that were not replaced, then the answers of the changed checklists.
+            # replace the old spreadsheet in one step, then save the watermark. if the run fails, the old spreadsheet and watermark are kept.
+            with open(csv_filename + '.tmp', 'w', newline='') as file:
+                writer = csv.writer(file, quoting=csv.QUOTE_NONNUMERIC, delimiter=',', quotechar='"')
+                writer.writerow(self.FIELDNAMES)
+                if os.path.exists(csv_filename):
+                    with open(csv_filename, newline='') as old_file:
+                        self.copyRows(old_file, file, lambda row: row[0] not in replaced)
+                # the columns of a row are checklist_id, ..., checklist_updated. see FIELDNAMES
+                with open(csv_filename + '.changed.tmp', newline='') as changed_file:
+                    self.copyRows(changed_file, file, lambda row: row[0] in replaced and row[5] == changed[row[0]])
+                writer.writerows(refetched_rows)
+            os.replace(csv_filename + '.tmp', csv_filename)
+            watermark.save()
+        finally:
+            if os.path.exists(csv_filename + '.changed.tmp'):
+                os.remove(csv_filename + '.changed.tmp')
+
+        if self.REFETCH:
+            self.log('\nWARNING: {} checklists could not be read, their previous answers were kept: {}'.format(len(self.REFETCH), ', '.join(str(id) for id in self.REFETCH)), True)
+
+        self.log('\n{} checklists changed. Completed in {}'.format(len(changed), datetime.timedelta(seconds = (datetime.datetime.now() - start).seconds)), True)
+
+        return None
+
+    def copyRows(self, old_file, new_file, keep):
+        '''Copies the rows of a .csv spreadsheet created by this class to another file, skipping the header. Only the rows for which keep(row) returns
+        True are copied. keep is given the values of the row as strings. Rows are copied as they are, so values keep their original quoting.'''
+
+        # csv.reader only returns parsed values. keep the raw lines it reads, so each row can be copied as it was written. a row can span several lines.
+        lines = []
+        def readLines():
+            for line in old_file:
+                lines.append(line)
+                yield line
+
+        reader = csv.reader(readLines())
+        next(reader, None) # skip the header
+        lines.clear()
+        for row in reader:
+            if row and keep(row):
+                new_file.writelines(lines)
+            lines.clear()
+
+        return None
+
+    def prefetchLookups(self, checklists):
+        '''Looks up the areas, lines, machines and products used by a page of checklists in bulk, and stores them in the L2L cache. This way
+        formatChecklistAnswers finds them in the cache instead of making one API call per id. Ids that are not returned by the bulk lookup are
+        left for formatChecklistAnswers to look up one at a time.'''
+
+        for field, url in self.LOOKUPS:
+            # collect the ids on this page that have not been looked up yet
+            ids = set()
+            for checklist in checklists:
+                if checklist[field] and not self.L2L.isCached(url, {'site':self.SITE['site'], 'id':checklist[field]}):
+                    ids.add(checklist[field])
+            ids = sorted(ids)
+
+            # look up the ids in batches, and store every object returned under the same key formatChecklistAnswers uses
+            for i in range(0, len(ids), self.LOOKUPBATCHSIZE):
+                batch = ids[i:i + self.LOOKUPBATCHSIZE]
+                items = self.L2L.doGetAll(url, {'site':self.SITE['site'], 'id__in':','.join(str(id) for id in batch)})
+                self.L2L.primeCacheMany(url, [({'site':self.SITE['site'], 'id':item['id']}, item) for item in items])
+
+        return None
+
     def formatChecklistAnswers(self, checklist):
-        '''Re-formats a checklist object into a list of answers.'''
+        '''Re-formats a checklist object into a list of answers. Each answer is an object with a value for each of the FIELDNAMES.'''
+
+        return [dict(zip(self.FIELDNAMES, row)) for row in self.flattenChecklist(checklist)]
+
+    def flattenChecklist(self, checklist):
+        '''Re-formats a checklist object into a list of rows, one per answer. Each row is a tuple of values in the order of the FIELDNAMES.
+        Faster than formatChecklistAnswers, because the checklist values shared by all answers are only built once.'''
+
+        # sometimes python leaves the task list as a string instead of parsing it. skip the checklist, and fetch it again at the end of the export.
+        # fetching it again usually works.
+        if isinstance(checklist['tasks'], str):
+            self.log(['tasks is not an object. fetching checklist {} again later.'.format(checklist['id']), checklist['tasks']])
+            if checklist['id'] not in self.REFETCH:
+                self.REFETCH.append(checklist['id'])
+            return []
+
+        document = self.documentRow(checklist)
+        # the answers were already flattened if the checklist came from decodeChecklists
+        answer_rows = checklist['answer_rows'] if 'answer_rows' in checklist else flattenAnswers(checklist)
+        return [document + answer for answer in answer_rows]
+
+    def documentRow(self, checklist):
+        '''Returns the values shared by all answers of a checklist, in the order of the DOCUMENTFIELDS. Looks up the Area, Line, Machine and Product.'''
 
         # get the Area, Line, Machine, Product info
         area = line = machine = product = {'code':'', 'description': ''} # default values
         if checklist['area']:
             area = self.L2L.doGetWithCache('areas', {'site':self.SITE['site'], 'id':checklist['area']})
-        # line = {'code':'', 'description': ''} # default line values
         if checklist['line']:
             line = self.L2L.doGetWithCache('lines', {'site':self.SITE['site'], 'id':checklist['line']})
-        # machine = {'code':'', 'description': ''} # default machine values
         if checklist['machine']:
             machine = self.L2L.doGetWithCache('machines', {'site':self.SITE['site'], 'id':checklist['machine']})
-        # product = {'code':'', 'description': ''} # default product values
         if checklist['product']:
             product = self.L2L.doGetWithCache('productcomponents', {'site':self.SITE['site'], 'id':checklist['product']})
 
-        answers = []
-        # shared document variables. these are attributes that are shared by all answers.
-        document = {
-            'checklist_id': checklist['id'],
-            'document_id':checklist['document'], 
-            'document_name': checklist['name'], 
-            'checklist_number': checklist['number'], 
-            'checklist_created': checklist['created'], 
-            'checklist_updated': checklist['lastupdated'],
-            'checklist_udpated_by': checklist['lastupdatedby'],
-            'checklist_closed': checklist['closed'],
-            'checklist_closed_date': checklist['closeddate'], 
-            'dispatch_number': checklist['dispatch'], 
-            'area_id': checklist['area'], 
-            'area_code': area['code'],
-            'area_description': area['description'],
-            'line_id': checklist['line'], 
-            'line_code': line['code'], 
-            'line_description': line['description'], 
-            'machine_id': checklist['machine'], 
-            'machine_code': machine['code'], 
-            'machine_description': machine['description'], 
-            'technology_id': checklist['technology'], 
-            'product_id': checklist['product'], 
-            'product_code': product['code'], 
-            'product_description': product['description'], 
-            'product_order_id': checklist['product_order'], 
-            'build_sequence_id': checklist['build_sequence'],
-        }
-
-        # sometimes python leaves the task list as a string instead of parsing it. skip the checklist. re-running the script for the same date range usally works the second time.
-        if isinstance(checklist['tasks'], str):
-            self.log(['tasks is not an object. skipping the checklist.', checklist['tasks']])
-            return answers
-
-        # loop through all checklist answers. dataset contains one record per checklist answer, even if the answer is inside a table.
-        if checklist['answers'] is not None:
-            for answer in checklist['answers']:
-                # if the answer is part of a table, pull the question text accordingly
-                if answer['table_row_number'] is not None and answer['table_column_number'] is not None:
-                    question = checklist['tasks'][int(answer['task_number'])-1]['table']['rows'][int(answer['table_row_number'])-1]['columns'][int(answer['table_column_number'])-1]['text']
-                # question was not inside a table
-                else:
-                    question = checklist['tasks'][int(answer['task_number'])-1]['text']
-                # append the answer the answers list
-                answers.append({
-                    **document,
-                    'question': question,
-                    'answer_na': answer['na'], 
-                    'answer': answer['answer'], 
-                    'answer_created': answer['created'], 
-                    'answer_by': answer['lastupdatedby'], 
-                    'control_limit_low': answer['control_limit_low'], 
-                    'control_limit_high': answer['control_limit_high'], 
-                    'reject_limit_low': answer['reject_limit_low'], 
-                    'reject_limit_high': answer['reject_limit_high'],
-                })
-        return answers
+        return (
+            checklist['id'], checklist['document'], checklist['name'], checklist['number'], checklist['created'], checklist['lastupdated'],
+            checklist['lastupdatedby'], checklist['closed'], checklist['closeddate'], checklist['dispatch'],
+            checklist['area'], area['code'], area['description'],
+            checklist['line'], line['code'], line['description'],
+            checklist['machine'], machine['code'], machine['description'],
+            checklist['technology'],
+            checklist['product'], product['code'], product['description'],
+            checklist['product_order'], checklist['build_sequence'],
+        )
     
     def getCurrentDateTimeStrForFilename(self):
         '''Returns the current date time in a format that can be used to name files.'''
@@ -269,21 +688,9 @@ class ChecklistAnswers:
         return date_time.strftime(format)
 
     def log(self, items, verbose = False):
-        '''Outputs an item or list of items to a log file. Accepts strings and json objects. Can also output the string to the terminal.'''
-        # create a list if only a single item is passed in. doing so simplifies the rest of this method.
-        if not isinstance(items, list):
-            items = [items]
-        
-        for item in items:
-            if(self.LOGFILENAME):
-                with open(self.LOGFILENAME, 'a') as logfile:
-                    logfile.write(item+'\n')
-            # output to the terminal
-            if self.VERBOSE or verbose:
-                if type(item) is json:
-                    print(json.dumps(item, indent=4, separators=(',', ': ')))
-                else:
-                    print(item)
+        '''Outputs an item or list of items to the log file. Accepts strings and json objects. Can also output the string to the terminal.'''
+
+        self.LOGGER.write(items, self.VERBOSE or verbose)
         return None
 
 
@@ -1,33 +1,116 @@
 # from botocore.vendored import requests
 import requests
+from requests.adapters import HTTPAdapter
 import dateutil
 import datetime
 import json
 import time
+import collections
+import concurrent.futures
+import threading
+import sqlite3
+import random
+import email.utils
+import uuid
+import os
+import contextlib
+import queue
+import atexit
+import asyncio
+try:
+    import aiohttp  # only needed by AsyncL2LApi
+except ImportError:
+    aiohttp = None
+
+
+def decodeResult(content, limit=1):
+    '''Decodes the raw body of an L2L API response the same way doGet does. Returns the data of the response, only the first object if limit is 1,
+    or None if the request was not successful. A module level function, so it can run in another process.
+    Variables:
+        content : The raw body of the response. e.g. from L2LApi.doGetRaw
+        limit : The limit the request was made with. defaults to 1'''
+
+    try:
+        resultJson = json.loads(content)
+    except ValueError:
+        return None
+
+    if isinstance(resultJson, dict) and resultJson.get('success') and resultJson.get('data'):
+        # only return the top object if the request was for a single object
+        if limit == 1 and len(resultJson['data']) > 0 and isinstance(resultJson['data'], list):
+            return resultJson['data'][0]
+        else:
+            return resultJson['data']
+    return None
+
+
+def makeCacheKey(data):
+    '''Builds the key used by doGetWithCache to store and look up cached items. e.g. {"site":1, "id":1234} becomes "site-1-id-1234"
+    A module level function, so L2LApi and AsyncL2LApi build the same keys, and can share a cache.'''
+
+    cache_key_arr = []
+    for key, value in data.items():
+        cache_key_arr.extend((str(key), str(value)))
+    return '-'.join(cache_key_arr)
 
 
 class L2LApi:
     '''Make API requests to a server running Leading2Lean's CloudDISPATCH. See l2l.com for more info.'''
 
-    def __init__(self, url, auth, verbose=False):
+    def __init__(self, url, auth, verbose=False, pool_connections=10, pool_maxsize=10, pool_block=False, timeout=None, cache=None, rate_limiter=None, max_retries=5, metrics=None, logger=None):
         '''Sets up the L2LApi class.
         Variables:
             url : The URL of the CloudDISPATCH server. e.g. https://customer.leading2lean.com/api/1.0/
             auth : The authorization key for the server
-            verbose : Set to True if you want to see logging in the terminal'''
+            verbose : Set to True if you want to see logging in the terminal
+            pool_connections : The number of hosts to keep connection pools for. defaults to 10
+            pool_maxsize : The maximum number of keep-alive connections kept open per host. defaults to 10
+            pool_block : Set to True to make requests wait for a free connection instead of opening an extra one when the pool is full
+            timeout : Seconds to wait for the server before giving up on a request. defaults to None (wait forever)
+            cache : The cache used by doGetWithCache, e.g. MemoryCache or SQLiteCache. defaults to an unbounded MemoryCache
+            rate_limiter : The RateLimiter that spaces out requests. Share one between several classes talking to the same server. defaults to RateLimiter()
+            max_retries : The number of times a request is retried after a 429, a 5xx (GET only) or a connection error before giving up. defaults to 5
+            metrics : The Metrics that record every request. Share one between several classes to get a single summary. defaults to Metrics()
+            logger : The LogWriter the log entries are written with. Share one between several classes writing to the same log file. defaults to LogWriter()'''
 
         self.URL = url
         self.AUTH = auth
         self.VERBOSE = verbose
-        self.LOGFILENAME = None
-        self.CACHE = {}  # e.g. {'dispatches': {1234: {'id':1234, 'number':'2345', ...}}}
+        self.TIMEOUT = timeout
+        self.LOGGER = logger if logger is not None else LogWriter()
+        self.CACHE = cache if cache is not None else MemoryCache()
+        self.LIMITER = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.MAXRETRIES = max_retries
+        self.METRICS = metrics if metrics is not None else Metrics()
+        self.INFLIGHT = SingleFlight()  # GETs that are waiting on the L2L server. identical concurrent GETs share one request.
+        self.SUBMITTED = MemoryCache(maxsize=100000, ttl=10 * 60)  # the idempotency keys given to doPostBatch that were posted successfully, and their results
+
+        # share one session across all calls so TCP/TLS connections are kept alive and reused instead of re-opened per request
+        self.SESSION = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self.SESSION.mount('https://', adapter)
+        self.SESSION.mount('http://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        '''Closes all pooled connections to the L2L server, and waits for the log entries to be written. The class can still be used afterwards, but
+        new connections will have to be opened.'''
+
+        self.SESSION.close()
+        self.LOGGER.flush()
 
     def setLogFilename(self, log_filename):
         '''Sets the filename of a log file to be used to log each API call. If this is not set, no log entries will be made.
         Variables:
             log_filename : The full path of the log file.'''
 
-        self.LOGFILENAME = log_filename
+        self.LOGGER.setFilename(log_filename)
 
     def doPost(self, url, data, limit=1):
         '''Perform a POST operation on the L2L server.
@@ -37,81 +120,388 @@ class L2LApi:
             limit : The number of results to be returned. defaults to 1'''
 
         # perform the actual POST
-        result = requests.post(self.URL + url, {'auth': self.AUTH, 'limit': limit, **data})
-        # retry if needed
-        if self.__doIntelligentRetry(result):
-            return self.doPost(url, data, limit)
+        result = self.__doRequest('POST', url, {'auth': self.AUTH, 'limit': limit, **data})
 
         return self.__finishRequest('POST', result, limit)
 
+    def doPostBatch(self, url, payloads, workers=4, limit=1, key=None, registry=None):
+        '''Performs a POST operation on the L2L server for each payload, several at the same time. Returns a list with one object per payload, in the
+        order of the payloads. See iterPostBatch for the variables and the objects returned.'''
+
+        return sorted(self.iterPostBatch(url, payloads, workers, limit, key, registry), key=lambda item: item['index'])
+
+    def iterPostBatch(self, url, payloads, workers=4, limit=1, key=None, registry=None):
+        '''Performs a POST operation on the L2L server for each payload, with up to workers POSTs in flight at the same time. Payloads are read as
+        workers become free, so they can come from a generator that keeps producing events. Every POST goes through the rate limiter and is retried
+        after a 429 like doPost. Yields one object per payload as soon as its POST finishes, e.g.
+        {"index": 0, "key": "3f2a...", "payload": {...}, "result": {"id": 1234, ...}, "error": None, "duplicate": False}
+        "error" is None if the POST succeeded, otherwise the reason it failed.
+
+        Each payload has an idempotency key, which is sent in the Idempotency-Key header of the POST and of its retries. Without a key function,
+        each payload gets a new unique key, so every payload is posted, even if two are the same.
+        With a key function, the key of every successful POST is stored in the registry with its result. A payload whose key is already in the
+        registry is not posted again: its stored result is returned with "duplicate" set to True. So a batch with failures can simply be sent again,
+        and only the failed payloads are posted. Payloads with the same key that are in flight at the same time share one POST. Only the payload
+        that made the POST has "duplicate" set to False, so counting the items where it is False counts the POSTs made.
+        Variables:
+            url : The path of the API call. e.g. dispatches/open
+            payloads : An iterable of objects to send in the POST body. e.g. [{"dispatchtypecode":"CODE RED", "description":"Machine is down" ... }, ...]
+            workers : The number of POSTs in flight at the same time. Keep this at or below the pool_maxsize of the class. defaults to 4
+            limit : The number of results to be returned per POST. defaults to 1
+            key : Optional function that returns the idempotency key of a payload, e.g. the id of the event that caused it. defaults to a new unique key per payload
+            registry : The cache the keys from the key function are stored in, e.g. a SQLiteCache to keep them between runs. defaults to self.SUBMITTED,
+            which keeps them for 10 minutes, and at most 100000 of them'''
+
+        if key is None:
+            registry = None
+        elif registry is None:
+            registry = self.SUBMITTED
+        workers = max(1, workers)
+        payloads = iter(payloads)
+        end = object()  # marks the end of the payloads. None is a payload, and is reported as an error.
+        finished = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}  # e.g. {future: {"index": 0, "key": "3f2a...", "payload": {...}}}
+            index = 0
+            while True:
+                # keep a payload queued behind each worker, so a worker never waits for the next payload to be read
+                while not finished and len(pending) < 2 * workers:
+                    payload = next(payloads, end)
+                    if payload is end:
+                        finished = True
+                        break
+                    item = {'index': index, 'key': None, 'payload': payload}
+                    index += 1
+                    try:
+                        if not isinstance(payload, dict):
+                            raise TypeError('the payload is not an object')
+                        item['key'] = str(key(payload)) if key is not None else uuid.uuid4().hex
+                    except Exception as error:
+                        yield {**item, 'result': None, 'error': '{}: {}'.format(type(error).__name__, error), 'duplicate': False}
+                        continue
+                    pending[executor.submit(self.__postItem, url, payload, limit, item['key'], registry)] = item
+                if not pending:
+                    return
+
+                # hand back the POSTs as they finish
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    try:
+                        item['result'], item['duplicate'] = future.result()
+                        item['error'] = None
+                    # any failure only fails its own payload. the POSTs still in flight are handed back as usual.
+                    except Exception as error:
+                        item['result'], item['duplicate'] = None, False
+                        item['error'] = '{}: {}'.format(type(error).__name__, error)
+                    yield item
+
+    def __postItem(self, url, payload, limit, key, registry):
+        '''Private method. Posts one payload for iterPostBatch, unless its key is in the registry. Returns a (result, duplicate) tuple.
+        Without a registry, the key is unique, so the payload is always posted.'''
+
+        if registry is None:
+            return self.__postOnce(url, payload, limit, key, registry)
+        found, result = registry.get(url, key)
+        if found:
+            return result, True
+        # a payload that waited for the POST of another payload with the same key is a duplicate of it
+        (result, duplicate), shared = self.INFLIGHT.call(('POST', url, key), self.__postOnce, url, payload, limit, key, registry)
+        return result, duplicate or shared
+
+    def __postOnce(self, url, payload, limit, key, registry):
+        '''Private method. Performs the actual POST for __postItem, and stores the key in the registry if it succeeded. Raises ValueError if it did not.'''
+
+        result = self.__doRequest('POST', url, {'auth': self.AUTH, 'limit': limit, **payload}, {'Idempotency-Key': key})
+        try:
+            success = bool(result.json()['success'])
+        except (ValueError, KeyError, TypeError):
+            success = False
+        if not success:
+            self.__log(' : POST : {} : {}'.format(result.elapsed, result.url))
+            self.__log(str(result.status_code) + ': ' + result.text)
+            raise ValueError('status {}: {}'.format(result.status_code, result.text[:500]))
+
+        value = self.__finishRequest('POST', result, limit)
+        if registry is not None:
+            registry.set(url, key, value)
+        return value, False
+
     def doGet(self, url, data, limit=1):
         '''Performs a GET operation on the L2L server.
         Variables:
             url : The path of the API call. e.g. dispatches
             data : An object of variables to send in the request. e.g. {"dispatchnumber":"12345"}
-            limit : The number of results to be returned. defaults to 1'''
+            limit : The number of results to be returned. defaults to 1
+        If another thread is already making the same GET, waits for it and returns its result instead of asking the server again.
+        The result is shared between those threads, so do not change it in place.'''
+
+        key = ('GET', url, json.dumps(data, sort_keys=True, default=str), limit)
+        return self.INFLIGHT.do(key, self.__doGet, url, data, limit)
+
+    def __doGet(self, url, data, limit):
+        '''Private method. Performs the actual GET for doGet.'''
 
         # perform the actual GET
-        result = requests.get(self.URL + url, {'auth': self.AUTH, 'limit': limit, **data})
-        # retry if needed
-        if self.__doIntelligentRetry(result):
-            return self.doGet(url, data, limit)
+        result = self.__doRequest('GET', url, {'auth': self.AUTH, 'limit': limit, **data})
 
         return self.__finishRequest('GET', result, limit)
 
-    def doGetAll(self, url, data, limit=500):
+    def doGetAll(self, url, data, limit=500, workers=1):
         '''Performs a GET operation on the L2L server, returning all results across all pages. This method should only be used when all objects are needed from L2L.
         Variables:
             url : The path of the API call. e.g. dispatches
             data : An object of variables to send in the request. **Be sure to include all possible filters to decrease the load on the server.**
             e.g. {"dispatchtypecode":"CODE RED", "created__gte":"2020-01-01 00:00:00", "created__lt":"2020-01-08 00:00:00"}
-            limit : The number of results to be returned per page. defaults to 500'''
+            limit : The number of results to be returned per page. defaults to 500
+            workers : The number of pages to fetch at the same time. defaults to 1 (one page after another)'''
+
+        return list(self.iterGetAll(url, data, limit, workers, prefetch=False))
+
+    def iterGetAll(self, url, data, limit=500, workers=1, prefetch=True, on_page=None, decoder=None, executor=None, window=None):
+        '''Performs GET operations on the L2L server, yielding every result across all pages one at a time. Unlike doGetAll, only the pages currently
+        being fetched are kept in memory, so this should be used for large result sets.
+        Variables:
+            url : The path of the API call. e.g. dispatches
+            data : An object of variables to send in the request. **Be sure to include all possible filters to decrease the load on the server.**
+            limit : The number of results to be returned per page. defaults to 500
+            workers : The number of pages to fetch at the same time. defaults to 1
+            prefetch : Set to True to request the next page while the current page is being processed. defaults to True
+            on_page : Optional function called with each page of results before its results are yielded. e.g. to report progress
+            decoder, executor, window : See iterGetPages'''
+
+        for result in self.iterGetPages(url, data, limit, workers, prefetch, decoder, executor, window):
+            if on_page is not None:
+                on_page(result)
+            yield from result
+
+    def iterGetChanged(self, url, data, watermark, limit=500, on_page=None):
+        '''Performs GET operations on the L2L server, yielding only the results created or changed since the watermark was last saved. Results are
+        requested in order of the watermark field, and each result yielded moves the watermark forward. Call watermark.save() once the results have
+        been stored, so the next run starts where this one ended.
+        Pages are requested from the value of the watermark field seen last, not by offset. A result that changes during the pull moves to the end of
+        the order, which would shift the later results down an offset and skip one of them. Results on the boundary are recognised by their id.
+        Variables:
+            url : The path of the API call. e.g. dispatches
+            data : An object of variables to send in the request. e.g. {"site":1}
+            watermark : The Watermark of the previous run. e.g. Watermark('dispatches.json', 'lastupdated')
+            limit : The number of results to be returned per page. defaults to 500
+            on_page : Optional function called with each page of results before its results are yielded'''
 
-        result_all = []
-        finished = False
         offset = 0
+        while True:
+            cursor = watermark.NEXTVALUE
+            params = {**data, 'order_by': watermark.FIELD, 'offset': offset}
+            if cursor is not None:
+                params[watermark.FIELD + '__gte'] = cursor
+            page = self.doGet(url, params, limit)
+            if isinstance(page, dict):
+                page = [page]
+            if not page:
+                return None
+            if on_page is not None:
+                on_page(page)
+
+            for result in page:
+                # skip the results on the boundary that were already pulled, by this run or the previous one
+                if result[watermark.FIELD] is not None and result[watermark.FIELD] == watermark.NEXTVALUE and result['id'] in watermark.NEXTIDS:
+                    continue
+                if watermark.isNew(result):
+                    watermark.update(result)
+                    yield result
 
-        while not finished:
-            # perform the actual GET
-            result = self.doGet(url, {**data, 'offset': offset}, limit)
-            # append the result to the result_all list
-            if result is not None:
-                result_all.extend(result)
             # last result. stop the loop
-            if result is None or len(result) < limit:
+            if len(page) < limit:
+                return None
+            # the next page starts at the last value seen. if the whole page had the same value, asking from it again would return the same page,
+            # so page through the results with that value by offset instead.
+            offset = offset + limit if watermark.NEXTVALUE == cursor else 0
+
+    def iterGetPages(self, url, data, limit=500, workers=1, prefetch=False, decoder=None, executor=None, window=None):
+        '''Performs GET operations on the L2L server page by page, yielding each page of results in offset order as soon as it is available.
+        Variables:
+            url : The path of the API call. e.g. dispatches
+            data : An object of variables to send in the request. Paging starts at data['offset'] if it is provided, otherwise at 0.
+            limit : The number of results to be returned per page. defaults to 500
+            workers : The number of pages to fetch at the same time. When more than 1, pages N..N+workers are requested concurrently.
+            Keep this at or below the pool_maxsize of the class so each worker gets its own keep-alive connection.
+            prefetch : Set to True to request the next page before the current page is handed back, so fetching overlaps with processing. Always on when workers is more than 1.
+            decoder : Optional function that turns the raw body of a response into a page, called as decoder(content, limit). It must return a list with
+            one item per result, so the last page can be found. defaults to decoding the JSON like doGet. e.g. decodeResult
+            executor : Optional concurrent.futures executor the decoder runs on, e.g. a ProcessPoolExecutor so decoding does not hold the GIL of this
+            process. The decoder must then be a module level function. defaults to running the decoder in the thread that fetched the page
+            window : The most pages requested ahead of the page being handed back, counting the pages being fetched and the pages being decoded.
+            Only workers pages are fetched at the same time. A worker starts on the next page as soon as its page is fetched, while the page is
+            decoded on the executor. Set it to workers plus the number of processes of the executor to keep every process busy.
+            defaults to workers, or 2 x workers with an executor'''
+
+        offset = int(data.get('offset', 0))
+
+        # fetch one page after another
+        if workers <= 1 and not prefetch:
+            finished = False
+            while not finished:
+                # perform the actual GET
+                result = self.__resolvePage(self.__fetchPage(url, {**data, 'offset': offset}, limit, decoder, executor))
+                if result:
+                    self.METRICS.recordPage(url)
+                    yield result
+                # last result. stop the loop
+                if result is None or len(result) < limit:
+                    finished = True
+                else:
+                    offset += len(result)
+            return
+
+        # fetch a window of pages at the same time. pages are handed back in the order they were requested, so results stay in offset order.
+        workers = max(1, workers)
+        window = max(workers, window or (2 * workers if executor is not None else workers))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as fetch_executor:
+            pending = collections.deque()  # a future per page, in offset order. its result is the page, or a future of the page while it is decoded.
+            finished = False
+
+            def refill():
+                # request the next pages while fewer than workers pages are being fetched and the window is not full
+                nonlocal offset
+                while not finished and len(pending) < window and sum(not future.done() for future in pending) < workers:
+                    pending.append(fetch_executor.submit(self.__fetchPage, url, {**data, 'offset': offset}, limit, decoder, executor))
+                    offset += limit
+
+            try:
+                while not finished:
+                    # wait for the next page. each time a page is fetched, the next one is requested, even if the pages before it are still decoded.
+                    while True:
+                        refill()
+                        waiting = [future for future in pending if not future.done()]
+                        if pending[0].done():
+                            page = pending[0].result()
+                            if not isinstance(page, concurrent.futures.Future) or page.done():
+                                break
+                            waiting.append(page)
+                        concurrent.futures.wait(waiting, return_when=concurrent.futures.FIRST_COMPLETED)
+                    pending.popleft()
+                    result = self.__resolvePage(page)
+                    # last result. the pages still in flight are past the end, drop them.
+                    if result is None or len(result) < limit:
+                        finished = True
+                    # keep the window full before handing the page back
+                    else:
+                        refill()
+                    if result:
+                        self.METRICS.recordPage(url)
+                        yield result
+            finally:
                 finished = True
-            else:
-                offset += len(result)
+                for future in pending:
+                    future.cancel()
+                    if future.done() and not future.cancelled() and future.exception() is None and isinstance(future.result(), concurrent.futures.Future):
+                        future.result().cancel()
 
-        return result_all
+    def __fetchPage(self, url, data, limit, decoder, executor):
+        '''Private method. Fetches one page for iterGetPages. Returns the page, or a future of the page if the decoder runs on an executor.'''
+
+        if decoder is None:
+            return self.doGet(url, data, limit)
+        content = self.doGetRaw(url, data, limit)
+        if executor is not None:
+            return executor.submit(decoder, content, limit)
+        return decoder(content, limit)
+
+    def __resolvePage(self, page):
+        '''Private method. Waits for a page returned by __fetchPage if it is still being decoded.'''
+
+        if isinstance(page, concurrent.futures.Future):
+            return page.result()
+        return page
+
+    def doGetRaw(self, url, data, limit=1):
+        '''Performs a GET operation on the L2L server, and returns the raw body of the response (bytes) without decoding it. Use decodeResult to
+        decode it later, or in another process.
+        Variables:
+            url : The path of the API call. e.g. dispatches
+            data : An object of variables to send in the request. e.g. {"dispatchnumber":"12345"}
+            limit : The number of results to be returned. defaults to 1'''
+
+        result = self.__doRequest('GET', url, {'auth': self.AUTH, 'limit': limit, **data})
+        self.__log(' : {} : {} : {}'.format('GET', result.elapsed, result.url))
+        # the body is decoded later, maybe in another process, so log a failed request here, like doGet does. e.g. an error status, an HTML error
+        # page, or "success": false. error bodies are small, so only small bodies are decoded to check them.
+        failed = not result.ok or not result.content.lstrip().startswith(b'{')
+        if not failed and len(result.content) < 4096:
+            try:
+                resultJson = result.json()
+                failed = not isinstance(resultJson, dict) or not resultJson.get('success')
+            except ValueError:
+                failed = True
+        if failed:
+            self.__log(str(result.status_code) + ': ' + result.text)
+        return result.content
 
     def doGetWithCache(self, url, data):
         '''Performs a GET operation, and caches the result. This decreases the number of API calls performed on a server, which will speed up an application.
         ONLY USE THIS METHOD TO LOOK UP ITEMS BY CODE OR BY KEY. Otherwise, results will be inconsistent. `limit` is hard coded to 1 to enforce this assumption.
-        Cache is only stored in memory. Cache will be destroyed when the application terminates.'''
+        By default the cache is only stored in memory, and is destroyed when the application terminates. Pass a SQLiteCache to the class to keep it between runs.
+        A result of None (the request failed, or nothing was found) is not cached, so the next call asks the server again.'''
 
         # build a key to store and look up cached items
-        cache_key_arr = []
-        for key, value in data.items():
-            cache_key_arr.extend((str(key), str(value)))
-        cache_key = '-'.join(cache_key_arr)
-
-        # no cached item. perform the API call, cache the result
-        if url not in self.CACHE or cache_key not in self.CACHE[url]:
-            result = self.doGet(url, data, 1)
-            if url not in self.CACHE:
-                self.CACHE[url] = {}
-            self.CACHE[url][cache_key] = result
+        cache_key = makeCacheKey(data)
 
         # return from cache
-        return self.CACHE[url][cache_key]
+        found, result = self.CACHE.get(url, cache_key)
+        if found:
+            return result
+
+        # no cached item. perform the API call, cache the result. threads that miss the same item at the same time share one API call.
+        return self.INFLIGHT.do(('CACHE', url, cache_key), self.__doGetAndCache, url, data, cache_key)
+
+    def __doGetAndCache(self, url, data, cache_key):
+        '''Private method. Performs the GET for doGetWithCache and caches the result, unless another thread cached it in the meantime.'''
+
+        if self.CACHE.contains(url, cache_key):
+            found, result = self.CACHE.get(url, cache_key)
+            if found:
+                return result
+
+        result = self.doGet(url, data, 1)
+        # do not cache a failed lookup (an error after the retries, or not found), or it would be returned until it expires, even from a file
+        if result is not None:
+            self.CACHE.set(url, cache_key, result)
+        return result
+
+    def isCached(self, url, data):
+        '''Returns True if doGetWithCache already has a result for this url and data, and will not need to call the L2L server.'''
+
+        return self.CACHE.contains(url, makeCacheKey(data))
+
+    def primeCache(self, url, data, result):
+        '''Stores a result that doGetWithCache will return for this url and data. Use this to fill the cache from a bulk request, e.g. store each
+        machine returned by doGetAll('machines', ...) under {'site': site, 'id': machine['id']}, instead of looking up each machine one at a time.
+        Variables:
+            url : The path of the API call. e.g. machines
+            data : The variables doGetWithCache will be called with. Must be in the same order. e.g. {"site":1, "id":1234}
+            result : The object to return for the call'''
+
+        self.CACHE.set(url, makeCacheKey(data), result)
+
+    def primeCacheMany(self, url, items):
+        '''Stores several results that doGetWithCache will return, like primeCache, in one go. Much faster than primeCache with a SQLiteCache.
+        Variables:
+            url : The path of the API call. e.g. machines
+            items : A list of (data, result) tuples. e.g. [({"site":1, "id":1234}, {...}), ...]'''
+
+        self.CACHE.setMany(url, [(makeCacheKey(data), result) for data, result in items])
 
     def __finishRequest(self, verb, result, limit):
         '''Private method. Finishes the doPost and doGet methods with common reporting and return strategies'''
 
         self.__log(' : {} : {} : {}'.format(verb, result.elapsed, result.url))
 
-        resultJson = result.json()
+        try:
+            resultJson = result.json()
+        except ValueError:
+            # e.g. an HTML error page after the retries ran out
+            self.__log(str(result.status_code) + ': ' + result.text)
+            return None
 
         if resultJson['success'] and resultJson['data']:
             # only return the top object if the request was for a single object
@@ -124,18 +514,44 @@ class L2LApi:
             self.__log(str(result.status_code) + ': ' + result.text)
             return None
 
-    def __doIntelligentRetry(self, result):
-        '''Retry the request if status 429 is returned. Will pause for the number of seconds indicated in the "Retry-After" header, if provided. If none is
-        provided, will pause for 5 seconds'''
+    def __doRequest(self, verb, url, params, headers=None):
+        '''Private method. Performs a request once the rate limiter allows it, and retries it in a loop if the server is busy.
+        Retries after status 429 for every request. Retries after a 5xx status or a connection error only for GET, because a POST may already have been
+        processed. Waits for the number of seconds in the "Retry-After" header if it is provided, otherwise backs off exponentially with jitter.
+        Gives up after max_retries retries, returning the last response (or raising the last connection error).'''
 
-        if result.status_code == 429:
-            retry_seconds = 5
-            if result.headers['Retry-After']:
-                retry_seconds = int(result.headers['Retry-After'])
-            self.__log('WARNING: received status 429. retrying in {} seconds.'.format(retry_seconds), True)
+        attempt = 0
+        while True:
+            self.LIMITER.acquire()
+            start = time.monotonic()
+            try:
+                if verb == 'POST':
+                    result = self.SESSION.post(self.URL + url, data=params, headers=headers, timeout=self.TIMEOUT)
+                else:
+                    result = self.SESSION.get(self.URL + url, params=params, headers=headers, timeout=self.TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                self.METRICS.recordRequest(verb, url, None, time.monotonic() - start)
+                if verb == 'POST' or attempt >= self.MAXRETRIES:
+                    raise
+                self.LIMITER.onThrottle()
+                reason, retry_after = type(error).__name__, None
+            else:
+                self.METRICS.recordRequest(verb, url, result.status_code, time.monotonic() - start, len(result.content))
+                if result.status_code != 429 and (result.status_code < 500 or verb == 'POST'):
+                    self.LIMITER.onSuccess()
+                    return result
+                retry_after = self.LIMITER.parseRetryAfter(result.headers.get('Retry-After'))
+                self.LIMITER.onThrottle(retry_after)
+                if attempt >= self.MAXRETRIES:
+                    self.__log('ERROR: received status {}. giving up after {} retries.'.format(result.status_code, attempt), True)
+                    return result
+                reason = 'status {}'.format(result.status_code)
+
+            retry_seconds = retry_after if retry_after is not None else self.LIMITER.backoff(attempt)
+            self.METRICS.recordRetry(url)
+            self.__log('WARNING: received {}. retrying in {:.1f} seconds.'.format(reason, retry_seconds), True)
             time.sleep(retry_seconds)
-            return True
-        return False
+            attempt += 1
 
     def makeDateString(self, date_time, format="%Y-%m-%d %H:%M:%S"):
         '''Creates a date/time string using the date_time provided.
@@ -148,21 +564,1049 @@ class L2LApi:
         return date_time.strftime(format)
 
     def __log(self, items, verbose=False):
-        '''Outputs an item or list of items to a log file. Accepts strings and json objects. Can also output each item to the terminal.'''
+        '''Outputs an item or list of items to the log file. Accepts strings and json objects. Can also output each item to the terminal.'''
+
+        self.LOGGER.write(items, self.VERBOSE or verbose)
+        return None
+
+
+class LogWriter:
+    '''Writes log entries to a file from a background thread, so logging does not wait on the disk. Entries are queued, and everything queued
+    while the previous entries were being written is written and flushed in one go. The file is rotated before it goes past max_bytes: log.log is
+    renamed to log.log.1, log.log.1 to log.log.2, and so on, keeping the given number of backups. Safe to share between several classes and threads.
+
+    Sample usage:
+    logger = LogWriter('C:/logs/l2l.log')
+    l2l = L2LApi(url, auth, logger=logger)
+    logger.write({'event': 'started', 'site': 1})
+    logger.close()'''
+
+    # the maximum number of entries written in one go
+    BATCHSIZE = 10000
+
+    def __init__(self, filename=None, max_bytes=10000000, backups=5):
+        '''Sets up the LogWriter class.
+        Variables:
+            filename : The full path of the log file. If this is not set, no log entries will be made.
+            max_bytes : The size in bytes the file is rotated at. Set to None to never rotate. defaults to 10 MB
+            backups : The number of rotated files to keep. defaults to 5'''
+
+        self.FILENAME = filename
+        self.MAXBYTES = max_bytes
+        self.BACKUPS = backups
+        self.QUEUE = queue.Queue()  # (filename, line) entries waiting to be written. None stops the writer thread.
+        self.THREAD = None
+        self.FILE = None
+        self.LOCK = threading.Lock()
+
+    def setFilename(self, filename):
+        '''Sets the full path of the log file. Entries already written keep going to the previous file.'''
+
+        self.FILENAME = filename
+
+    def write(self, items, verbose=False):
+        '''Writes an item or list of items to the log file, one line each. Strings are written as they are, json objects (dicts and lists) are written
+        as one line of JSON. Set verbose to True to also output each item to the terminal straight away.'''
 
         # create a list if only a single item is passed in. doing so simplifies the rest of this method.
         if not isinstance(items, list):
             items = [items]
 
-        # loop through each item, and write it to the log
         for item in items:
-            if(self.LOGFILENAME):
-                with open(self.LOGFILENAME, 'a') as logfile:
-                    logfile.write(item+'\n')
+            if self.FILENAME:
+                self.__start()
+                line = json.dumps(item, default=str) if isinstance(item, (dict, list)) else str(item)
+                self.QUEUE.put((self.FILENAME, line))
             # output to the terminal
-            if self.VERBOSE or verbose:
-                if type(item) is json:
-                    print(json.dumps(item, indent=4, separators=(',', ': ')))
+            if verbose:
+                if isinstance(item, (dict, list)):
+                    print(json.dumps(item, indent=4, separators=(',', ': '), default=str))
                 else:
                     print(item)
         return None
+
+    def flush(self):
+        '''Waits until every entry written so far is in the log file.'''
+
+        if self.THREAD is not None:
+            self.QUEUE.join()
+
+    def close(self):
+        '''Writes the remaining entries, closes the file and stops the writer thread. Writing again afterwards starts a new writer thread.'''
+
+        with self.LOCK:
+            if self.THREAD is None:
+                return None
+            self.QUEUE.put(None)
+            self.THREAD.join()
+            self.THREAD = None
+            atexit.unregister(self.close)
+
+    def __start(self):
+        '''Private method. Starts the writer thread the first time an entry is written. The remaining entries are written when the program exits.'''
+
+        if self.THREAD is not None:
+            return None
+        with self.LOCK:
+            if self.THREAD is None:
+                self.THREAD = threading.Thread(target=self.__run, name='LogWriter', daemon=True)
+                self.THREAD.start()
+                atexit.register(self.close)
+
+    def __run(self):
+        '''Private method. The writer thread. Takes everything that is queued, writes it, and flushes the file once per batch.'''
+
+        stop = False
+        while not stop:
+            batch = [self.QUEUE.get()]
+            while len(batch) < self.BATCHSIZE:
+                try:
+                    batch.append(self.QUEUE.get_nowait())
+                except queue.Empty:
+                    break
+
+            # write consecutive lines for the same file together
+            lines = []
+            for entry in batch:
+                if entry is None or (lines and entry[0] != lines[0][0]):
+                    self.__writeLines(lines)
+                    lines = []
+                if entry is None:
+                    stop = True
+                else:
+                    lines.append(entry)
+            self.__writeLines(lines)
+            for _ in batch:
+                self.QUEUE.task_done()
+
+        if self.FILE is not None:
+            self.FILE.close()
+            self.FILE = None
+
+    def __writeLines(self, lines):
+        '''Private method. Writes a list of (filename, line) entries for the same file. Rotates the file before the line that would take it past
+        max_bytes, so a file only goes past max_bytes if a single line is bigger than that.'''
+
+        if not lines:
+            return None
+        filename = lines[0][0]
+        try:
+            if self.FILE is not None and self.FILE.name != filename:
+                self.FILE.close()
+                self.FILE = None
+            if self.FILE is None:
+                self.FILE = open(filename, 'a', encoding='utf-8')
+            # write the lines in as few calls as possible, splitting them where the file is rotated
+            chunk = []
+            size = self.FILE.tell()
+            for _, line in lines:
+                line += '\n'
+                length = len(line.encode('utf-8'))
+                if self.MAXBYTES and size > 0 and size + length > self.MAXBYTES:
+                    self.FILE.write(''.join(chunk))
+                    chunk = []
+                    self.__rotate(filename)
+                    size = 0
+                chunk.append(line)
+                size += length
+            self.FILE.write(''.join(chunk))
+            self.FILE.flush()
+        except OSError as error:
+            # never stop the program because the log cannot be written, e.g. a network share went away. try again with the next batch.
+            print('WARNING: cannot write to log file {}: {}'.format(filename, error))
+            if self.FILE is not None:
+                self.FILE.close()
+                self.FILE = None
+        return None
+
+    def __rotate(self, filename):
+        '''Private method. Renames log.log to log.log.1, log.log.1 to log.log.2 and so on, removes the oldest file, and opens a new log.log.'''
+
+        self.FILE.close()
+        if self.BACKUPS > 0:
+            for i in range(self.BACKUPS - 1, 0, -1):
+                if os.path.exists('{}.{}'.format(filename, i)):
+                    os.replace('{}.{}'.format(filename, i), '{}.{}'.format(filename, i + 1))
+            os.replace(filename, filename + '.1')
+            self.FILE = open(filename, 'a', encoding='utf-8')
+        else:
+            self.FILE = open(filename, 'w', encoding='utf-8')
+
+
+class Metrics:
+    '''Records every API call made by L2LApi and AsyncL2LApi: latency histograms, bytes received, status codes, retries and pages per endpoint.
+    Hooks can be added to receive each event as it happens, e.g. to forward them to a monitoring system, and span() times any block of code.
+    If an OpenTelemetry tracer is provided, span() also creates an OpenTelemetry span. Safe to use from several threads.
+
+    Sample usage:
+    metrics = Metrics()
+    metrics.addHook(lambda event: print(event))
+    l2l = L2LApi(url, auth, metrics=metrics)
+    with metrics.span('nightly pull', site=1):
+        l2l.doGetAll('dispatches', {'site': 1})
+    print(metrics.summary(l2l.CACHE))'''
+
+    # the upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+    def __init__(self, tracer=None, logger=None):
+        '''Sets up the Metrics class.
+        Variables:
+            tracer : Optional OpenTelemetry tracer. e.g. opentelemetry.trace.get_tracer(__name__)
+            logger : Optional LogWriter hook errors are written to. defaults to printing them'''
+
+        self.TRACER = tracer
+        self.LOGGER = logger
+        self.HOOKS = []
+        self.HOOKERRORS = 0
+        self.ENDPOINTS = {}  # e.g. {'checklists': {'requests': 10, 'seconds': 5.2, 'histogram': [...], ...}}
+        self.SPANS = {}  # e.g. {'export': {'count': 1, 'seconds': 62.1, 'errors': 0}}
+        self.STARTED = time.monotonic()
+        self.LOCK = threading.Lock()
+
+    def addHook(self, hook):
+        '''Adds a function that is called with each event. Events are objects with a "type" of request, retry, page or span. e.g.
+        {"type": "request", "verb": "GET", "endpoint": "checklists", "status": 200, "seconds": 0.21, "bytes": 51234}
+        Hooks run in the thread that made the API call. An error raised by a hook is logged and counted, and does not fail the API call.'''
+
+        self.HOOKS.append(hook)
+
+    def recordRequest(self, verb, endpoint, status, seconds, bytes_received=0):
+        '''Records one attempt of an API call. status is None if no response was received.'''
+
+        with self.LOCK:
+            stats = self.__endpoint(endpoint)
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            stats['maxseconds'] = max(stats['maxseconds'], seconds)
+            stats['bytes'] += bytes_received
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            if status == 429:
+                stats['throttled'] += 1
+            elif status is None or status >= 400:
+                stats['errors'] += 1
+            for i, bucket in enumerate(self.BUCKETS):
+                if seconds <= bucket:
+                    stats['histogram'][i] += 1
+                    break
+        self.__emit({'type': 'request', 'verb': verb, 'endpoint': endpoint, 'status': status, 'seconds': seconds, 'bytes': bytes_received})
+
+    def recordRetry(self, endpoint):
+        '''Records that an API call is being retried.'''
+
+        with self.LOCK:
+            self.__endpoint(endpoint)['retries'] += 1
+        self.__emit({'type': 'retry', 'endpoint': endpoint})
+
+    def recordPage(self, endpoint):
+        '''Records that a page of results was fetched.'''
+
+        with self.LOCK:
+            self.__endpoint(endpoint)['pages'] += 1
+        self.__emit({'type': 'page', 'endpoint': endpoint})
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        '''Times a block of code. e.g. with metrics.span('export', site=1): ...
+        The time is added to the summary, and a span event is sent to the hooks when the block ends.'''
+
+        start = time.monotonic()
+        error = None
+        with (self.TRACER.start_as_current_span(name, attributes=attributes) if self.TRACER is not None else contextlib.nullcontext()):
+            try:
+                yield
+            except BaseException as exception:
+                error = exception
+                raise
+            finally:
+                seconds = time.monotonic() - start
+                with self.LOCK:
+                    stats = self.SPANS.setdefault(name, {'count': 0, 'seconds': 0.0, 'errors': 0})
+                    stats['count'] += 1
+                    stats['seconds'] += seconds
+                    stats['errors'] += error is not None
+                self.__emit({'type': 'span', 'name': name, 'attributes': attributes, 'seconds': seconds, 'error': repr(error) if error is not None else None})
+
+    def percentile(self, endpoint, fraction):
+        '''Returns the upper bound of the histogram bucket the given fraction of requests to an endpoint finished in. e.g. percentile('checklists', 0.95)'''
+
+        with self.LOCK:
+            stats = self.ENDPOINTS.get(endpoint)
+            if not stats or not stats['requests']:
+                return None
+            target = fraction * stats['requests']
+            count = 0
+            for bucket, bucket_count in zip(self.BUCKETS, stats['histogram']):
+                count += bucket_count
+                if count >= target:
+                    return bucket
+        return None
+
+    def stats(self):
+        '''Returns a copy of all recorded metrics. e.g. {"endpoints": {...}, "spans": {...}, "hookerrors": 0, "seconds": 62.5}'''
+
+        with self.LOCK:
+            return json.loads(json.dumps({'endpoints': self.ENDPOINTS, 'spans': self.SPANS, 'hookerrors': self.HOOKERRORS, 'seconds': time.monotonic() - self.STARTED}, default=str))
+
+    def summary(self, cache=None):
+        '''Returns a readable summary of all recorded metrics, one line per endpoint and span. Includes the statistics of the cache if provided.'''
+
+        # work from a copy, because other threads may still be recording
+        snapshot = self.stats()
+        lines = ['API calls:']
+        for endpoint in sorted(snapshot['endpoints']):
+            stats = snapshot['endpoints'][endpoint]
+            average = stats['seconds'] / stats['requests'] if stats['requests'] else 0.0
+            lines.append('  {}: {} requests, {} pages, {:.1f} MB, avg {:.3f}s, p50 <= {}s, p95 <= {}s, max {:.3f}s, {} retries, {} throttled (429), {} errors'.format(
+                endpoint, stats['requests'], stats['pages'], stats['bytes'] / 1000000, average, self.percentile(endpoint, 0.5), self.percentile(endpoint, 0.95),
+                stats['maxseconds'], stats['retries'], stats['throttled'], stats['errors']))
+        for name in sorted(snapshot['spans']):
+            stats = snapshot['spans'][name]
+            lines.append('  span {}: {} times, {:.1f}s total, {} errors'.format(name, stats['count'], stats['seconds'], stats['errors']))
+        if snapshot['hookerrors']:
+            lines.append('  hooks: {} errors'.format(snapshot['hookerrors']))
+        if cache is not None:
+            lines.append('  cache: {hits} hits, {misses} misses, {hitrate:.0%} hit rate, {size} items, {evictions} evictions'.format(**cache.stats()))
+        return '\n'.join(lines)
+
+    def __endpoint(self, endpoint):
+        '''Private method. Returns the statistics of an endpoint, creating them the first time. Must be called while holding the lock.'''
+
+        if endpoint not in self.ENDPOINTS:
+            self.ENDPOINTS[endpoint] = {'requests': 0, 'pages': 0, 'retries': 0, 'throttled': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0, 'maxseconds': 0.0,
+                                        'histogram': [0] * len(self.BUCKETS), 'statuses': {}}
+        return self.ENDPOINTS[endpoint]
+
+    def __emit(self, event):
+        '''Private method. Sends an event to every hook. A failing hook must not fail the API call it reports on, or the threads sharing that call,
+        so its error is only logged. Only the first error is logged in full, the others are counted in the summary.'''
+
+        for hook in self.HOOKS:
+            try:
+                hook(event)
+            except Exception as error:
+                with self.LOCK:
+                    self.HOOKERRORS += 1
+                    first = self.HOOKERRORS == 1
+                if first:
+                    message = 'WARNING: metrics hook {!r} failed on a {} event: {}: {}'.format(hook, event['type'], type(error).__name__, error)
+                    if self.LOGGER is not None:
+                        self.LOGGER.write(message, True)
+                    else:
+                        print(message)
+
+
+class RateLimiter:
+    '''Spaces out requests to the L2L server with a token bucket that can be shared by several threads and classes. The rate adapts to the server:
+    it is cut each time the server answers 429 or 5xx, and climbs back to the configured rate over time while requests succeed. When the server sends a
+    "Retry-After" header, every request waits until that time has passed, not just the one that got the 429.
+    Without a rate, requests are not spaced out at all until the server answers 429 or 5xx. Then the rate starts at half the rate requests were being
+    sent at, and once it has climbed back to that rate, requests are no longer spaced out.
+
+    Sample usage:
+    limiter = RateLimiter(rate=10)
+    dispatches = L2LApi(url, auth, rate_limiter=limiter)
+    checklists = L2LApi(url, auth, rate_limiter=limiter)'''
+
+    def __init__(self, rate=None, burst=None, min_rate=0.5, decrease=0.5, increase=0.05, max_backoff=60):
+        '''Sets up the RateLimiter class.
+        Variables:
+            rate : The maximum number of requests per second. defaults to None (no limit until the server is busy)
+            burst : The number of requests that can be sent at once after a quiet period. defaults to rate
+            min_rate : The rate is never cut below this number of requests per second. defaults to 0.5
+            decrease : The rate is multiplied by this after a 429 or 5xx. defaults to 0.5 (halved)
+            increase : The fraction of the maximum rate added back per second while requests succeed. defaults to 0.05 (back from half in 10 seconds)
+            max_backoff : The longest pause in seconds between retries when the server does not send "Retry-After". defaults to 60'''
+
+        self.MAXRATE = float(rate) if rate else None
+        self.RATE = self.MAXRATE  # None while requests are not spaced out
+        self.CEILING = self.MAXRATE  # the rate climbed back to after a 429
+        self.BURST = float(burst if burst is not None else max(1, rate or 1))
+        self.MINRATE = min(float(min_rate), self.MAXRATE) if self.MAXRATE else float(min_rate)
+        self.RECENT = collections.deque()  # the times of the requests reserved in the last second, to know the rate to start from after a 429
+        self.DECREASE = decrease
+        self.INCREASE = increase
+        self.MAXBACKOFF = max_backoff
+        self.TOKENS = self.BURST
+        self.UPDATED = time.monotonic()
+        self.BLOCKEDUNTIL = 0.0
+        self.RECOVERED = time.monotonic()  # the time the rate was last moved back up, or cut
+        self.LOCK = threading.Lock()
+
+    def reserve(self):
+        '''Takes a token for one request. Returns the number of seconds to wait before sending it. Does not wait, so it can be used by asyncio code.'''
+
+        with self.LOCK:
+            now = time.monotonic()
+            if self.MAXRATE is None:
+                self.RECENT.append(now)
+                while self.RECENT[0] < now - 1:
+                    self.RECENT.popleft()
+            if self.RATE is None:
+                return max(0.0, self.BLOCKEDUNTIL - now)
+            self.TOKENS = min(self.BURST, self.TOKENS + (now - self.UPDATED) * self.RATE)
+            self.UPDATED = now
+            # tokens can go below zero. each request waits until the tokens taken before it have been refilled.
+            self.TOKENS -= 1
+            return max(0.0, -self.TOKENS / self.RATE, self.BLOCKEDUNTIL - now)
+
+    def acquire(self):
+        '''Waits until a request can be sent.'''
+
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def onSuccess(self):
+        '''Tells the rate limiter a request succeeded. Moves the rate back towards the maximum rate, by the time since it was last moved, not by the
+        number of requests, so a burst of requests that were already in flight does not undo a cut. Without a rate, stops spacing out requests once
+        the rate is back to where it was before the server got busy.'''
+
+        with self.LOCK:
+            if self.RATE is None:
+                return None
+            now = time.monotonic()
+            if now <= self.RECOVERED:
+                return None
+            self.RATE = min(self.CEILING, self.RATE + self.INCREASE * self.CEILING * (now - self.RECOVERED))
+            self.RECOVERED = now
+            if self.MAXRATE is None and self.RATE >= self.CEILING:
+                self.RATE = None
+
+    def onThrottle(self, retry_after=None):
+        '''Tells the rate limiter the server is busy (429, 5xx or no connection). Cuts the rate, and blocks all requests for retry_after seconds if provided.'''
+
+        with self.LOCK:
+            # without a rate, start spacing out requests from the rate they were sent at during the last second
+            if self.RATE is None:
+                self.CEILING = max(self.MINRATE, float(len(self.RECENT)))
+                self.RATE = self.CEILING
+                self.BURST = max(1.0, self.CEILING)
+                self.TOKENS = 0.0
+                self.UPDATED = time.monotonic()
+            self.RATE = max(self.MINRATE, self.RATE * self.DECREASE)
+            self.TOKENS = min(self.TOKENS, 0.0)
+            if retry_after is not None:
+                self.BLOCKEDUNTIL = max(self.BLOCKEDUNTIL, time.monotonic() + retry_after)
+            # only start climbing back once the server lets requests through again
+            self.RECOVERED = max(time.monotonic(), self.BLOCKEDUNTIL)
+
+    def backoff(self, attempt):
+        '''Returns a random number of seconds to wait before retry number attempt (starting at 0). Doubles with each attempt, up to max_backoff.'''
+
+        return random.uniform(0, min(self.MAXBACKOFF, 2 ** (attempt + 1)))
+
+    def parseRetryAfter(self, value):
+        '''Returns the number of seconds in a "Retry-After" header, which can be a number of seconds or a date. Returns None if it is missing or invalid.'''
+
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_date = email.utils.parsedate_to_datetime(value)
+            return max(0.0, (retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+class SingleFlight:
+    '''Makes concurrent identical calls share one call. The first thread to call do() with a key runs the function. Any other thread that calls do()
+    with the same key while it is running waits for it, and gets the same result (or exception) instead of running the function again.'''
+
+    def __init__(self):
+        '''Sets up the SingleFlight class.'''
+
+        self.LOCK = threading.Lock()
+        self.CALLS = {}  # e.g. {('GET', 'machines', ...): Future}
+
+    def do(self, key, function, *args):
+        '''Runs function(*args), unless a call with the same key is already running. Then waits for that call and returns its result.
+        Variables:
+            key : A hashable key that identifies identical calls
+            function : The function to run
+            args : The arguments to pass to the function'''
+
+        return self.call(key, function, *args)[0]
+
+    def call(self, key, function, *args):
+        '''Same as do, but returns a (result, shared) tuple. shared is True if the result came from a call another thread was already running.'''
+
+        with self.LOCK:
+            future = self.CALLS.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self.CALLS[key] = future
+
+        # another thread is already making this call. share its result.
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = function(*args)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self.LOCK:
+                del self.CALLS[key]
+
+
+class MemoryCache:
+    '''Stores results for L2LApi.doGetWithCache in memory. Once maxsize items are stored, the least recently used item is removed to make room.
+    Items can also expire after a number of seconds, either for all API calls or per API call. Safe to use from several threads.
+
+    Sample usage:
+    cache = MemoryCache(maxsize=10000, ttl=24 * 60 * 60, ttls={'dispatches': 60})
+    l2l = L2LApi(url, auth, cache=cache)'''
+
+    def __init__(self, maxsize=None, ttl=None, ttls=None):
+        '''Sets up the MemoryCache class.
+        Variables:
+            maxsize : The maximum number of items to keep. defaults to None (no limit)
+            ttl : The number of seconds an item is kept before it is looked up again. defaults to None (never expires)
+            ttls : An object of seconds per API call, used instead of ttl. e.g. {"areas": 86400, "dispatches": 60}'''
+
+        self.MAXSIZE = maxsize
+        self.TTL = ttl
+        self.TTLS = ttls or {}
+        self.ITEMS = collections.OrderedDict()  # e.g. {('machines', 'site-1-id-1234'): (expires, {'id':1234, 'code':'M1', ...})}
+        self.STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+        self.NEXTSWEEP = None  # the time.time() set looks for expired items next
+        self.LOCK = threading.RLock()
+
+    def get(self, url, key):
+        '''Looks up a cached item. Returns a (found, value) tuple, because None is a valid cached value.'''
+
+        with self.LOCK:
+            item = self.ITEMS.get((url, key))
+            if item is not None and item[0] is not None and item[0] <= time.time():
+                del self.ITEMS[(url, key)]
+                self.STATS['expirations'] += 1
+                item = None
+            if item is None:
+                self.STATS['misses'] += 1
+                return False, None
+
+            self.ITEMS.move_to_end((url, key))
+            self.STATS['hits'] += 1
+            return True, item[1]
+
+    def set(self, url, key, value, expires=None):
+        '''Stores an item, removing the least recently used items if the cache is full. Expired items are also removed from time to time, so a
+        cache with a TTL does not keep growing with items that are never looked up again.
+        Variables:
+            expires : The time.time() the item expires at. defaults to now plus the TTL for the url
+        Returns the time the item expires at.'''
+
+        now = time.time()
+        if expires is None:
+            ttl = self.TTLS.get(url, self.TTL)
+            expires = now + ttl if ttl is not None else None
+        with self.LOCK:
+            # remove the expired items once the first one has expired, then at most once per TTL, so each item is only checked a few times
+            if expires is not None:
+                if self.NEXTSWEEP is None:
+                    self.NEXTSWEEP = expires
+                elif self.NEXTSWEEP <= now:
+                    self.__sweep(now)
+                    self.NEXTSWEEP = expires
+            self.ITEMS[(url, key)] = (expires, value)
+            self.ITEMS.move_to_end((url, key))
+            while self.MAXSIZE is not None and len(self.ITEMS) > self.MAXSIZE:
+                self.ITEMS.popitem(last=False)
+                self.STATS['evictions'] += 1
+        return expires
+
+    def setMany(self, url, items, expires=None):
+        '''Stores several items of the same API call at once. items is a list of (key, value) tuples. See set.'''
+
+        item_expires = expires
+        with self.LOCK:
+            for key, value in items:
+                item_expires = self.set(url, key, value, expires)
+        return item_expires
+
+    def __sweep(self, now):
+        '''Private method. Removes every expired item. Must be called while holding the lock.'''
+
+        expired = [item_key for item_key, item in self.ITEMS.items() if item[0] is not None and item[0] <= now]
+        for item_key in expired:
+            del self.ITEMS[item_key]
+        self.STATS['expirations'] += len(expired)
+
+    def contains(self, url, key):
+        '''Returns True if an item is cached and has not expired. Does not count as a hit or a miss.'''
+
+        with self.LOCK:
+            item = self.ITEMS.get((url, key))
+        return item is not None and (item[0] is None or item[0] > time.time())
+
+    def clear(self):
+        '''Removes all cached items.'''
+
+        with self.LOCK:
+            self.ITEMS.clear()
+
+    def close(self):
+        '''Nothing to close for an in-memory cache. Exists so all caches can be closed the same way.'''
+
+        return None
+
+    def stats(self):
+        '''Returns the hit/miss statistics of the cache. e.g. {"hits": 90, "misses": 10, "hitrate": 0.9, "size": 10, ...}'''
+
+        with self.LOCK:
+            lookups = self.STATS['hits'] + self.STATS['misses']
+            return {**self.STATS, 'hitrate': self.STATS['hits'] / lookups if lookups else 0.0, 'size': len(self.ITEMS)}
+
+
+class SQLiteCache(MemoryCache):
+    '''Stores results for L2LApi.doGetWithCache in a SQLite database file, so master data like areas, lines and machines can be reused across runs.
+    Recently used items are also kept in memory, so lookups do not hit the disk after the first time. maxsize, ttl and ttls work like MemoryCache,
+    and maxsize also limits the number of items kept in the file. The least recently used items are removed from the file first, counting the
+    lookups answered from memory.
+
+    Sample usage:
+    cache = SQLiteCache('l2l-cache.sqlite', namespace=url, ttl=24 * 60 * 60)
+    l2l = L2LApi(url, auth, cache=cache)'''
+
+    def __init__(self, filename, namespace='', maxsize=None, ttl=None, ttls=None):
+        '''Sets up the SQLiteCache class. Expired items are removed from the file when it is opened.
+        Variables:
+            filename : The full path of the database file. It will be created if it does not exist.
+            namespace : Keeps items apart when one file is shared, e.g. the URL of the CloudDISPATCH server
+            maxsize : The maximum number of items to keep in memory and in the file. defaults to None (no limit)
+            ttl : The number of seconds an item is kept before it is looked up again. defaults to None (never expires)
+            ttls : An object of seconds per API call, used instead of ttl. e.g. {"areas": 86400, "dispatches": 60}'''
+
+        super().__init__(maxsize, ttl, ttls)
+        self.NAMESPACE = namespace
+        self.STATS['diskhits'] = 0
+        self.USED = {}  # the time each item was last looked up, since the file was last told. e.g. {('machines', 'site-1-id-1234'): 1600000000.0}
+        self.DB = sqlite3.connect(filename, check_same_thread=False)
+        with self.LOCK, self.DB:
+            self.DB.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, url TEXT, key TEXT, value TEXT, expires REAL, used REAL, PRIMARY KEY (namespace, url, key))')
+            self.DB.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+            self.__trim()
+
+    def get(self, url, key):
+        '''Looks up a cached item in memory, then in the file. Returns a (found, value) tuple, because None is a valid cached value.'''
+
+        with self.LOCK:
+            found, value = super().get(url, key)
+            if found:
+                self.__markUsed(url, key)
+                return found, value
+
+            row = self.DB.execute('SELECT value, expires FROM cache WHERE namespace = ? AND url = ? AND key = ?', (self.NAMESPACE, url, key)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= time.time()):
+                return False, None
+
+            # found in the file. keep it in memory for the next lookup. the miss counted above was really a hit.
+            value = json.loads(row[0])
+            super().set(url, key, value, row[1])
+            self.STATS['misses'] -= 1
+            self.STATS['hits'] += 1
+            self.STATS['diskhits'] += 1
+            self.__markUsed(url, key)
+            return True, value
+
+    def set(self, url, key, value, expires=None):
+        '''Stores an item in memory and in the file.'''
+
+        with self.LOCK, self.DB:
+            expires = super().set(url, key, value, expires)
+            self.DB.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)', (self.NAMESPACE, url, key, json.dumps(value), expires, time.time()))
+        return expires
+
+    def setMany(self, url, items, expires=None):
+        '''Stores several items of the same API call at once, in memory and in the file. The file is written in a single transaction, which is much
+        faster than calling set for each item. items is a list of (key, value) tuples.'''
+
+        with self.LOCK, self.DB:
+            now = time.time()
+            rows = []
+            for key, value in items:
+                item_expires = MemoryCache.set(self, url, key, value, expires)
+                rows.append((self.NAMESPACE, url, key, json.dumps(value), item_expires, now))
+            self.DB.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return rows[-1][4] if rows else expires
+
+    def contains(self, url, key):
+        '''Returns True if an item is cached in memory or in the file and has not expired. Does not count as a hit or a miss.'''
+
+        with self.LOCK:
+            if super().contains(url, key):
+                return True
+            row = self.DB.execute('SELECT expires FROM cache WHERE namespace = ? AND url = ? AND key = ?', (self.NAMESPACE, url, key)).fetchone()
+        return row is not None and (row[0] is None or row[0] > time.time())
+
+    def clear(self):
+        '''Removes all cached items in this namespace, from memory and from the file.'''
+
+        with self.LOCK, self.DB:
+            super().clear()
+            self.DB.execute('DELETE FROM cache WHERE namespace = ?', (self.NAMESPACE,))
+
+    def close(self):
+        '''Removes the least recently used items past maxsize from the file, and closes it.'''
+
+        with self.LOCK:
+            with self.DB:
+                self.__saveUsed()
+                self.__trim()
+            self.DB.close()
+
+    def __markUsed(self, url, key):
+        '''Private method. Remembers that an item was looked up. The times are written to the file in batches, and when it is closed.'''
+
+        self.USED[(url, key)] = time.time()
+        if len(self.USED) >= 1000:
+            with self.DB:
+                self.__saveUsed()
+
+    def __saveUsed(self):
+        '''Private method. Writes the times the items were last looked up to the file. Must be called inside a transaction.'''
+
+        if self.USED:
+            self.DB.executemany('UPDATE cache SET used = ? WHERE namespace = ? AND url = ? AND key = ?',
+                                [(used, self.NAMESPACE, url, key) for (url, key), used in self.USED.items()])
+            self.USED.clear()
+
+    def __trim(self):
+        '''Private method. Removes the least recently used items in this namespace past maxsize from the file.'''
+
+        if self.MAXSIZE is not None:
+            self.DB.execute('DELETE FROM cache WHERE namespace = ? AND rowid NOT IN (SELECT rowid FROM cache WHERE namespace = ? ORDER BY used DESC LIMIT ?)', (self.NAMESPACE, self.NAMESPACE, self.MAXSIZE))
+
+
+class Watermark:
+    '''Remembers how far an incremental pull got, in a small JSON file. Stores the highest value of a field like "lastupdated", plus the ids of the
+    results that have exactly that value, so results on the boundary are not pulled twice. Used with L2LApi.iterGetChanged.
+
+    Sample usage:
+    watermark = Watermark('dispatches-watermark.json', 'lastupdated', start='2020-01-01 00:00:00')
+    for dispatch in l2l.iterGetChanged('dispatches', {'site': 1}, watermark):
+        store(dispatch)
+    watermark.save()'''
+
+    def __init__(self, filename, field='lastupdated', start=None):
+        '''Sets up the Watermark class, and loads the last saved watermark from the file if it exists.
+        Variables:
+            filename : The full path of the JSON file
+            field : The date field results are compared on. Must be in the L2L date format, e.g. "2020-01-01 00:00:00". defaults to lastupdated
+            start : The value to start from if the file does not exist yet. defaults to None (pull everything)'''
+
+        self.FILENAME = filename
+        self.FIELD = field
+        self.VALUE = start
+        self.IDS = set()  # ids of the results whose field equals VALUE
+        self.STATE = {}  # other values the caller keeps with the watermark, e.g. the ids of results to pull again next run. saved as JSON.
+        if os.path.exists(filename):
+            with open(filename) as file:
+                saved = json.load(file)
+            self.VALUE = saved['value']
+            self.IDS = set(saved['ids'])
+            self.STATE = saved.get('state', {})
+        # the watermark of the results pulled during this run. becomes VALUE/IDS when saved.
+        self.NEXTVALUE = self.VALUE
+        self.NEXTIDS = set(self.IDS)
+
+    def params(self):
+        '''Returns the filter to send to the L2L server to get the results changed since the watermark. e.g. {"lastupdated__gte": "2020-01-01 00:00:00"}'''
+
+        if self.VALUE is None:
+            return {}
+        return {self.FIELD + '__gte': self.VALUE}
+
+    def isNew(self, result):
+        '''Returns True if the result was created or changed after the watermark of the previous run.'''
+
+        value = result[self.FIELD]
+        if self.VALUE is None or value is None:
+            return True
+        return value > self.VALUE or (value == self.VALUE and result['id'] not in self.IDS)
+
+    def update(self, result):
+        '''Moves the watermark forward to include the result.'''
+
+        value = result[self.FIELD]
+        if value is None:
+            return None
+        if self.NEXTVALUE is None or value > self.NEXTVALUE:
+            self.NEXTVALUE = value
+            self.NEXTIDS = set()
+        if value == self.NEXTVALUE:
+            self.NEXTIDS.add(result['id'])
+        return None
+
+    def save(self):
+        '''Saves the watermark and STATE to the file. The file is replaced in one step, so a crash never leaves a half written watermark. If no results
+        with a value were pulled, the previous watermark (or the start value) is kept.'''
+
+        if self.NEXTVALUE is not None:
+            self.VALUE = self.NEXTVALUE
+            self.IDS = set(self.NEXTIDS)
+        with open(self.FILENAME + '.tmp', 'w') as file:
+            json.dump({'field': self.FIELD, 'value': self.VALUE, 'ids': sorted(self.IDS), 'state': self.STATE}, file)
+        os.replace(self.FILENAME + '.tmp', self.FILENAME)
+
+
+class AsyncL2LApi:
+    '''Make API requests to a server running Leading2Lean's CloudDISPATCH from asyncio code. Has the same methods as L2LApi, but each one is a coroutine.
+    Requires the aiohttp package, see requirements.txt.
+
+    Sample usage:
+    async with AsyncL2LApi(url, auth) as l2l:
+        dispatch = await l2l.doGet('dispatches', {'dispatchnumber': '12345'})'''
+
+    def __init__(self, url, auth, verbose=False, max_concurrency=20, timeout=None, cache=None, rate_limiter=None, max_retries=5, metrics=None, logger=None):
+        '''Sets up the AsyncL2LApi class.
+        Variables:
+            url : The URL of the CloudDISPATCH server. e.g. https://customer.leading2lean.com/api/1.0/
+            auth : The authorization key for the server
+            verbose : Set to True if you want to see logging in the terminal
+            max_concurrency : The maximum number of requests in flight at the same time. Also the size of the connection pool. defaults to 20
+            timeout : Seconds to wait for the server before giving up on a request. defaults to None (wait forever)
+            cache : The cache used by doGetWithCache, e.g. MemoryCache or SQLiteCache. defaults to an unbounded MemoryCache
+            rate_limiter : The RateLimiter that spaces out requests. Can be shared with L2LApi classes talking to the same server. defaults to RateLimiter()
+            max_retries : The number of times a request is retried after a 429, a 5xx (GET only) or a connection error before giving up. defaults to 5
+            metrics : The Metrics that record every request. Can be shared with L2LApi classes. defaults to Metrics()
+            logger : The LogWriter the log entries are written with. Can be shared with L2LApi classes. defaults to LogWriter()'''
+
+        if aiohttp is None:
+            raise ImportError('AsyncL2LApi requires the aiohttp package. Install it with: pip install aiohttp')
+
+        self.URL = url
+        self.AUTH = auth
+        self.VERBOSE = verbose
+        self.TIMEOUT = timeout
+        self.MAXCONCURRENCY = max_concurrency
+        self.LOGGER = logger if logger is not None else LogWriter()
+        self.CACHE = cache if cache is not None else MemoryCache()
+        self.LIMITER = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.MAXRETRIES = max_retries
+        self.METRICS = metrics if metrics is not None else Metrics()
+        self.SEMAPHORE = asyncio.Semaphore(max_concurrency)
+        self.INFLIGHT = {}  # a future per doGetWithCache call in flight, so tasks that miss the same item at the same time share one API call
+        self.SESSION = None  # aiohttp sessions must be created inside the running event loop. see __getSession
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    async def close(self):
+        '''Closes all pooled connections to the L2L server.'''
+
+        if self.SESSION is not None:
+            await self.SESSION.close()
+            self.SESSION = None
+        await asyncio.get_running_loop().run_in_executor(None, self.LOGGER.flush)
+
+    def setLogFilename(self, log_filename):
+        '''Sets the filename of a log file to be used to log each API call. If this is not set, no log entries will be made.
+        Variables:
+            log_filename : The full path of the log file.'''
+
+        self.LOGGER.setFilename(log_filename)
+
+    async def doPost(self, url, data, limit=1):
+        '''Perform a POST operation on the L2L server.
+        Variables:
+            url : The path of the API call. e.g. dispatches/open
+            data : An object of variables to send in the POST body. e.g. {"dispatchtypecode":"CODE RED", "description":"Machine is down" ... }
+            limit : The number of results to be returned. defaults to 1'''
+
+        return await self.__doRequest('POST', url, {'auth': self.AUTH, 'limit': limit, **data}, limit)
+
+    async def doGet(self, url, data, limit=1):
+        '''Performs a GET operation on the L2L server.
+        Variables:
+            url : The path of the API call. e.g. dispatches
+            data : An object of variables to send in the request. e.g. {"dispatchnumber":"12345"}
+            limit : The number of results to be returned. defaults to 1'''
+
+        return await self.__doRequest('GET', url, {'auth': self.AUTH, 'limit': limit, **data}, limit)
+
+    async def doGetAll(self, url, data, limit=500, workers=1):
+        '''Performs a GET operation on the L2L server, returning all results across all pages. This method should only be used when all objects are needed from L2L.
+        Variables:
+            url : The path of the API call. e.g. dispatches
+            data : An object of variables to send in the request. **Be sure to include all possible filters to decrease the load on the server.**
+            limit : The number of results to be returned per page. defaults to 500
+            workers : The number of pages to request at the same time. defaults to 1 (one page after another)'''
+
+        result_all = []
+        offset = int(data.get('offset', 0))
+        pending = collections.deque()
+        for _ in range(max(1, workers)):
+            pending.append(asyncio.ensure_future(self.doGet(url, {**data, 'offset': offset}, limit)))
+            offset += limit
+
+        try:
+            while pending:
+                result = await pending.popleft()
+                if result:
+                    self.METRICS.recordPage(url)
+                    result_all.extend(result)
+                # last result. the pages still in flight are past the end, drop them.
+                if result is None or len(result) < limit:
+                    break
+                # keep the window full
+                pending.append(asyncio.ensure_future(self.doGet(url, {**data, 'offset': offset}, limit)))
+                offset += limit
+        finally:
+            # stop the pages still in flight, also when a page failed or this task was cancelled, and wait for them so their errors are retrieved
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        return result_all
+
+    async def doGetWithCache(self, url, data):
+        '''Performs a GET operation, and caches the result. See L2LApi.doGetWithCache.
+        ONLY USE THIS METHOD TO LOOK UP ITEMS BY CODE OR BY KEY. Otherwise, results will be inconsistent. `limit` is hard coded to 1 to enforce this assumption.'''
+
+        # build a key to store and look up cached items
+        cache_key = makeCacheKey(data)
+
+        while True:
+            # return from cache
+            found, result = self.CACHE.get(url, cache_key)
+            if found:
+                return result
+
+            # another task is already performing the API call. wait for its result.
+            future = self.INFLIGHT.get((url, cache_key))
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # only try again if the task performing the API call was cancelled, not this one
+                if not future.cancelled():
+                    raise
+
+        # no cached item. perform the API call, cache the result, and hand it to the tasks waiting for it
+        future = asyncio.get_running_loop().create_future()
+        self.INFLIGHT[(url, cache_key)] = future
+        try:
+            result = await self.doGet(url, data, 1)
+            # do not cache a failed lookup. see L2LApi.doGetWithCache
+            if result is not None:
+                self.CACHE.set(url, cache_key, result)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            future.exception()  # the waiting tasks raise the error themselves. stops asyncio warning if there are none.
+            raise
+        finally:
+            del self.INFLIGHT[(url, cache_key)]
+
+    def makeDateString(self, date_time, format="%Y-%m-%d %H:%M:%S"):
+        '''Creates a date/time string using the date_time provided.
+        Variables:
+            date_time : string or datetime object to be converted.
+            format : The format of the string. Defaults to the standard format accepted by L2L'''
+
+        if type(date_time) is str:
+            date_time = dateutil.parser.parse(date_time)
+        return date_time.strftime(format)
+
+    async def __getSession(self):
+        '''Private method. Returns the shared aiohttp session, creating it in the running event loop the first time it is needed.'''
+
+        if self.SESSION is None:
+            connector = aiohttp.TCPConnector(limit=self.MAXCONCURRENCY)
+            self.SESSION = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.TIMEOUT))
+        return self.SESSION
+
+    async def __doRequest(self, verb, url, params, limit):
+        '''Private method. Performs a request while holding a slot of the concurrency semaphore, once the rate limiter allows it. Retries work like
+        L2LApi: after a 429 for every request, after a 5xx or a connection error only for GET. The slot is released while waiting to retry, and the
+        wait uses asyncio.sleep, so it does not block the event loop.'''
+
+        # aiohttp only accepts strings and numbers. encode values the same way requests does: skip None, str() everything else.
+        params = {key: str(value) for key, value in params.items() if value is not None}
+        session = await self.__getSession()
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.LIMITER.reserve())
+            async with self.SEMAPHORE:
+                start = time.monotonic()
+                try:
+                    if verb == 'POST':
+                        response = await session.post(self.URL + url, data=params)
+                    else:
+                        response = await session.get(self.URL + url, params=params)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                    self.METRICS.recordRequest(verb, url, None, time.monotonic() - start)
+                    if verb == 'POST' or attempt >= self.MAXRETRIES:
+                        raise
+                    self.LIMITER.onThrottle()
+                    reason, retry_after = type(error).__name__, None
+                else:
+                    async with response:
+                        text = await response.text()
+                        elapsed = datetime.timedelta(seconds=time.monotonic() - start)
+                        status = response.status
+                        self.METRICS.recordRequest(verb, url, status, elapsed.total_seconds(), len(text.encode()))
+                        if status != 429 and (status < 500 or verb == 'POST'):
+                            self.LIMITER.onSuccess()
+                            return self.__finishRequest(verb, response, text, elapsed, limit)
+                        retry_after = self.LIMITER.parseRetryAfter(response.headers.get('Retry-After'))
+                        self.LIMITER.onThrottle(retry_after)
+                        if attempt >= self.MAXRETRIES:
+                            self.__log('ERROR: received status {}. giving up after {} retries.'.format(status, attempt), True)
+                            return self.__finishRequest(verb, response, text, elapsed, limit)
+                        reason = 'status {}'.format(status)
+
+            retry_seconds = retry_after if retry_after is not None else self.LIMITER.backoff(attempt)
+            self.METRICS.recordRetry(url)
+            self.__log('WARNING: received {}. retrying in {:.1f} seconds.'.format(reason, retry_seconds), True)
+            await asyncio.sleep(retry_seconds)
+            attempt += 1
+
+    def __finishRequest(self, verb, response, text, elapsed, limit):
+        '''Private method. Finishes the doPost and doGet methods with common reporting and return strategies'''
+
+        self.__log(' : {} : {} : {}'.format(verb, elapsed, response.url))
+
+        try:
+            resultJson = json.loads(text)
+        except ValueError:
+            # e.g. an HTML error page after the retries ran out
+            self.__log(str(response.status) + ': ' + text)
+            return None
+
+        if resultJson['success'] and resultJson['data']:
+            # only return the top object if the request was for a single object
+            if limit == 1 and len(resultJson['data']) > 0 and isinstance(resultJson['data'], list):
+                return resultJson['data'][0]
+            else:
+                return resultJson['data']
+        # log the response if the request was not successful.
+        else:
+            self.__log(str(response.status) + ': ' + text)
+            return None
+
+    def __log(self, items, verbose=False):
+        '''Outputs an item or list of items to the log file. Accepts strings and json objects. Can also output each item to the terminal.'''
+
+        self.LOGGER.write(items, self.VERBOSE or verbose)
+        return None